@@ -0,0 +1,272 @@
+"""Benchmarks `Drive` against the in-memory `MemoryDrive` backend.
+
+Every scenario runs in its own process so peak RSS is not shared between them.
+Results are written as JSON to `benchmarks/results/<commit>.json` and can be
+compared with an earlier run with `--compare`.
+
+    python benchmarks/bench_sync.py --latency 0.02
+    python benchmarks/bench_sync.py --compare benchmarks/results/<commit>.json
+"""
+import argparse
+import contextlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import ujson as json
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'scripts'))
+sys.path.insert(0, BENCHMARK_FOLDER)
+
+from memory_drive import MemoryDrive
+from key_manager import KeyManager
+from encrypt import rsa
+from file_index import RACY_WINDOW_NS
+from sync import Drive
+
+
+RESULTS_FOLDER = os.path.join(BENCHMARK_FOLDER, 'results')
+USERNAME = 'bench'
+
+
+def _write_file(root:str, path:str, data:bytes):
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as f:
+        f.write(data)
+
+
+def _text(rng:random.Random, size:int) -> bytes:
+    # Compressible, but not trivially so
+    words = [b'archive', b'encrypted', b'drive', b'sync', b'chunk', b'folder', b'message', b'key']
+    data = b' '.join(rng.choice(words) for _ in range(size // 6 + 1))
+    return data[:size]
+
+
+def many_small_files(root:str, scale:float, rng:random.Random):
+    for i in range(int(2000 * scale)):
+        size = rng.randint(100, 8 * 1024)
+        data = _text(rng, size) if i % 2 else rng.randbytes(size)
+        _write_file(root, f'folder{i % 20}/file{i}.txt', data)
+
+
+def few_huge_files(root:str, scale:float, rng:random.Random):
+    for i in range(4):
+        _write_file(root, f'huge{i}.bin', rng.randbytes(int(64 * 1024 * 1024 * scale)))
+
+
+def deep_nesting(root:str, scale:float, rng:random.Random):
+    for i in range(int(200 * scale)):
+        depth = 1 + i % 30
+        folder = '/'.join(f'level{level}' for level in range(depth))
+        _write_file(root, f'{folder}/file{i}.txt', _text(rng, rng.randint(100, 4 * 1024)))
+
+
+SCENARIOS = {
+    'many_small_files': many_small_files,
+    'few_huge_files': few_huge_files,
+    'deep_nesting': deep_nesting,
+}
+
+
+def peak_rss() -> int|None:
+    """Peak resident set size of this process in bytes"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _backdate(root:str):
+    # Files younger than the racy window are always rehashed, which would hide the warm cache
+    mtime_ns = time.time_ns() - 2 * RACY_WINDOW_NS
+    for folder, _, filenames in os.walk(root):
+        for filename in filenames:
+            os.utime(os.path.join(folder, filename), ns=(mtime_ns, mtime_ns))
+
+
+def run_scenario(name:str, scale:float, latency:float, messages:int) -> dict:
+    rng = random.Random(name)
+    work_folder = tempfile.mkdtemp(prefix=f'ceased-bench-{name}-')
+    try:
+        key_folder = os.path.join(work_folder, 'keys') + os.sep
+        source = os.path.join(work_folder, 'source')
+        destination = os.path.join(work_folder, 'destination')
+        os.makedirs(source)
+        os.makedirs(destination)
+
+        km = KeyManager(key_folder)
+        private_key, public_key = rsa.generate_key_pair()
+        km.set_key('user/private', private_key)
+        km.set_key('user/public', public_key)
+
+        SCENARIOS[name](source, scale, rng)
+        _backdate(source)
+        file_sizes = [
+            os.path.getsize(os.path.join(folder, filename))
+            for folder, _, filenames in os.walk(source) for filename in filenames
+        ]
+
+        gd = MemoryDrive(latency)
+        config = {"username": USERNAME, "key_folder": key_folder}
+        steps = {}
+
+        @contextlib.contextmanager
+        def step(step_name:str):
+            gd.reset_stats()
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                yield
+            # No peak RSS per step, ru_maxrss only ever grows within the scenario's process
+            steps[step_name] = {
+                "wall_time": time.perf_counter() - start,
+                **gd.stats(),
+            }
+
+        with step('init'):
+            drive = Drive(config, source, gd.root_folder_id, gd, km)
+
+        drive.file_index.entries = {}
+        with step('hash_files_cold'):
+            drive.hash_files()
+        with step('hash_files_warm'):
+            drive.hash_files()
+
+        with step('push_initial'):
+            drive.push()
+        with step('push_noop'):
+            drive.push()
+
+        with step('map_structure_full'):
+            drive.remote.map_structure(full=True)
+        with step('map_structure_incremental'):
+            drive.remote.map_structure()
+
+        with step('pull_fresh'):
+            Drive(config, destination, gd.root_folder_id, gd, km).pull()
+
+        for i in range(messages):
+            drive.chat.send_message(USERNAME, f'Benchmark message {i}')
+        with step('chat_refresh'):
+            drive.chat.refresh(force_download=True)
+
+        return {
+            "scale": scale,
+            "latency": latency,
+            "messages": messages,
+            "files": len(file_sizes),
+            "bytes": sum(file_sizes),
+            "steps": steps,
+            "peak_rss": peak_rss(),
+        }
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BENCHMARK_FOLDER, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _bytes_moved(stats:dict) -> int:
+    return stats['bytes_uploaded'] + stats['bytes_downloaded']
+
+
+def _change(before:float, after:float) -> str:
+    if not before:
+        return '-' if not after else 'new'
+    return f'{(after - before) / before:+.1%}'
+
+
+def compare(baseline:dict, current:dict):
+    print(f"{'scenario':<18} {'step':<26} {'time':>10} {'calls':>12} {'bytes':>12}")
+    for scenario, result in current['scenarios'].items():
+        base_steps = baseline['scenarios'].get(scenario, {}).get('steps', {})
+        for step_name, stats in result['steps'].items():
+            base = base_steps.get(step_name)
+            if base is None:
+                continue
+
+            print(
+                f"{scenario:<18} {step_name:<26} "
+                f"{_change(base['wall_time'], stats['wall_time']):>10} "
+                f"{_change(base['api_calls'], stats['api_calls']):>12} "
+                f"{_change(_bytes_moved(base), _bytes_moved(stats)):>12}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplier for file counts and sizes")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds of simulated latency per API call")
+    parser.add_argument('--messages', type=int, default=100, help="Chat messages to refresh")
+    parser.add_argument('--output', help="Result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', help="Earlier result file to compare with")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario {name}")
+
+    if args.run_scenario:
+        result = run_scenario(args.run_scenario, args.scale, args.latency, args.messages)
+        sys.stdout.write(json.dumps(result))
+        return
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "scenarios": {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        print(f"Running {name}...", file=sys.stderr)
+        process = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+                '--scale', str(args.scale), '--latency', str(args.latency), '--messages', str(args.messages)
+            ],
+            capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            print(f"Scenario {name} failed:\n{process.stderr}", file=sys.stderr)
+            continue
+        results['scenarios'][name] = json.loads(process.stdout)
+        for step_name, stats in results['scenarios'][name]['steps'].items():
+            print(
+                f"  {step_name:<26} {stats['wall_time']:8.3f}s {stats['api_calls']:6d} calls "
+                f"{_bytes_moved(stats):12d} bytes",
+                file=sys.stderr
+            )
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        f.write(json.dumps(results, indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            compare(json.loads(f.read()), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import itertools
+import threading
+import time
+
+from collections import Counter, defaultdict
+
+from storage import StorageBackend
+from google_drive import FOLDER_MIME_TYPE, BATCH_SIZE
+
+
+class MemoryDrive(StorageBackend):
+    """In-memory storage backend that behaves like `GoogleDrive`, used by the benchmarks.
+
+    Every API call sleeps for `latency` seconds and is counted per method.
+    Batch calls count one round trip per `BATCH_SIZE` requests, like the real batch endpoint.
+    """
+
+    def __init__(self, latency:float=0.0) -> None:
+        self.latency = latency
+        self.files:dict[str, dict] = {}
+        self.children:dict[str, set[str]] = defaultdict(set)
+        self.changes:list[str] = []
+        self.calls = Counter()
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.root_folder_id = self.create_folder('root')
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = Counter()
+            self.bytes_uploaded = 0
+            self.bytes_downloaded = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "api_calls": sum(self.calls.values()),
+                "api_calls_by_method": dict(self.calls),
+                "bytes_uploaded": self.bytes_uploaded,
+                "bytes_downloaded": self.bytes_downloaded,
+            }
+
+    def _call(self, method:str, count:int=1):
+        with self._lock:
+            self.calls[method] += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    def _call_batch(self, size:int):
+        self._call('batch', max(1, -(-size // BATCH_SIZE)))
+
+    def _add(self, name:str, parent_folder_id:str, mime_type:str, data:bytes=None) -> str:
+        with self._lock:
+            file_id = f'file{next(self._ids)}'
+            self.files[file_id] = {
+                "id": file_id,
+                "name": name,
+                "parents": [parent_folder_id] if parent_folder_id else [],
+                "mimeType": mime_type,
+                "data": data,
+            }
+            self.changes.append(file_id)
+            if parent_folder_id:
+                self.children[parent_folder_id].add(file_id)
+            if data:
+                self.bytes_uploaded += len(data)
+        return file_id
+
+    def _remove(self, file_id:str):
+        with self._lock:
+            removed = [file_id]
+            while removed:
+                current = removed.pop()
+                file = self.files.pop(current, None)
+                self.changes.append(current)
+                if file:
+                    for parent_id in file['parents']:
+                        self.children[parent_id].discard(current)
+                removed.extend(self.children.pop(current, ()))
+
+    def _read_upload(self, method:str, stream, chunksize:int) -> bytes:
+        size = stream.seek(0, 2)
+        stream.seek(0)
+        chunks = []
+        for _ in range(max(1, -(-size // chunksize))):
+            self._call(method)
+            chunks.append(stream.read(chunksize))
+        return b''.join(chunks)
+
+    def upload_stream(self, stream, name:str, parent_folder_id:str, mimetype:str='application/octet-stream', chunksize:int=8*1024*1024, session=None):
+        return self._add(name, parent_folder_id, mimetype, self._read_upload('upload_stream', stream, chunksize))
+
+    def update_stream(self, file_id:str, stream, mimetype:str='application/octet-stream', chunksize:int=8*1024*1024, session=None):
+        data = self._read_upload('update_stream', stream, chunksize)
+        with self._lock:
+            self.files[file_id]['data'] = data
+            self.changes.append(file_id)
+            self.bytes_uploaded += len(data)
+        return file_id
+
+    def download_to(self, file_id:str, stream, chunksize:int=8*1024*1024):
+        data = self.files[file_id]['data']
+        for offset in range(0, max(len(data), 1), chunksize):
+            self._call('download_to')
+            stream.write(data[offset:offset+chunksize])
+        with self._lock:
+            self.bytes_downloaded += len(data)
+
+    def _describe(self, file:dict) -> dict:
+        return {
+            "id": file['id'],
+            "name": file['name'],
+            "is_folder": file['mimeType'] == FOLDER_MIME_TYPE,
+            "mimeType": file['mimeType'],
+            "parents": file['parents'],
+            "trashed": False,
+        }
+
+    def list_folder(self, folder_id:str) -> list[dict]:
+        self._call('list_folder')
+        with self._lock:
+            return [self._describe(self.files[file_id]) for file_id in self.children.get(folder_id, ())]
+
+    def create_folder(self, name:str, parent_folder_id:str=None):
+        self._call('create_folder')
+        return self._add(name, parent_folder_id, FOLDER_MIME_TYPE)
+
+    def delete_file(self, file_id:str):
+        self._call('delete_file')
+        self._remove(file_id)
+
+    def delete_files(self, file_ids:list[str]) -> list:
+        self._call_batch(len(file_ids))
+        for file_id in file_ids:
+            self._remove(file_id)
+        return [None] * len(file_ids)
+
+    def create_folders(self, folders:list[tuple[str, str]]) -> list[str]:
+        self._call_batch(len(folders))
+        return [self._add(name, parent_folder_id, FOLDER_MIME_TYPE) for name, parent_folder_id in folders]
+
+    def get_start_page_token(self) -> str:
+        self._call('get_start_page_token')
+        return str(len(self.changes))
+
+    def list_changes(self, page_token:str, fields:list=None) -> tuple[list[dict], str]:
+        self._call('list_changes')
+        with self._lock:
+            changed_ids = self.changes[int(page_token):]
+            new_page_token = str(len(self.changes))
+            changes = []
+            for file_id in dict.fromkeys(changed_ids):
+                file = self.files.get(file_id)
+                changes.append({
+                    "fileId": file_id,
+                    "removed": file is None,
+                    "file": self._describe(file) if file else None,
+                })
+        return changes, new_page_token
@@ -5,10 +5,12 @@ import concurrent.futures
 from math import ceil,  floor
 from colorama import Fore, Style
 
+import startup
 from encrypt import rsa
 from key_manager import KeyManager
 from google_drive import GoogleDrive, CredentialsNotFoundError
-from sync import Drive
+from sync import Drive, create_storage
+from watch import WatchDaemon
 from config_loader import load_config, save_config
 
 CEASED_TITLE = R"""
@@ -22,6 +24,9 @@ CEASED_TITLE = R"""
 
    CEASED: CEASED: ENSURING A SECURELY ENCRYPTED DRIVE"""
 
+# Number of most recent messages shown in the chat menu
+CHAT_HISTORY_LENGTH = 50
+
 
 
 def print_block(title:str, rows:list[str], block_width:int=None):
@@ -130,12 +135,21 @@ class DriveMenu:
     def add_drive(self):
         label = input(f"Enter the {Style.BRIGHT}label{Style.RESET_ALL} of the drive: {Fore.MAGENTA}")
         local_path = input(f"{Style.RESET_ALL}Enter the local {Style.BRIGHT}path{Style.RESET_ALL} of the drive: {Fore.MAGENTA}")
-        remote_folder_id = input(f"{Style.RESET_ALL}Enter the remote {Style.BRIGHT}folder id{Style.RESET_ALL}: {Fore.MAGENTA}")
-
-        drive = {
-            'local_path': local_path,
-            'remote_folder_id': remote_folder_id
-        }
+        backend = input(f"{Style.RESET_ALL}Store in {Style.BRIGHT}1. Google Drive{Style.RESET_ALL} or {Style.BRIGHT}2. a directory{Style.RESET_ALL} (e.g. a NAS share) [1]: {Fore.MAGENTA}")
+
+        if backend == '2':
+            remote_path = input(f"{Style.RESET_ALL}Enter the remote {Style.BRIGHT}directory{Style.RESET_ALL}: {Fore.MAGENTA}")
+            drive = {
+                'local_path': local_path,
+                'backend': 'directory',
+                'remote_path': remote_path
+            }
+        else:
+            remote_folder_id = input(f"{Style.RESET_ALL}Enter the remote {Style.BRIGHT}folder id{Style.RESET_ALL}: {Fore.MAGENTA}")
+            drive = {
+                'local_path': local_path,
+                'remote_folder_id': remote_folder_id
+            }
 
         self.config['folders_to_sync'][label] = drive
         save_config(self.config)
@@ -145,8 +159,8 @@ class DriveMenu:
         try:
             drive_cfg = self.config['folders_to_sync'][drive_label]
             local_path = drive_cfg['local_path']
-            remote_folder_id = drive_cfg['remote_folder_id']
-            drive = Drive(self.config, local_path, remote_folder_id, GoogleDrive(), KeyManager('keys/'))
+            storage, remote_folder_id = create_storage(drive_cfg)
+            drive = Drive(self.config, local_path, remote_folder_id, storage, KeyManager('keys/'))
 
             KeyManager('keys/').delete_key(f'archives/{drive.id}')
 
@@ -221,7 +235,7 @@ class ChatMenu:
     def format_chat_history(self, user:str):
         rows = []
 
-        chat_history = self.drive.chat.get_messages(user)
+        chat_history = self.drive.chat.get_messages(user, limit=CHAT_HISTORY_LENGTH)
         chat_history = dict(sorted(chat_history.items(), key=lambda x: x[1]['timestamp']))
         for message_id, message_obj in chat_history.items():
             sender = message_obj['sender'].replace(self.drive.username, 'You')
@@ -300,9 +314,11 @@ class CLI:
             private, public = rsa.generate_key_pair()
             self.key_manager.set_key('user/private', private)
             self.key_manager.set_key('user/public', public)
+        startup.mark('config')
 
     def run(self):
         while True:
+            startup.mark('ready')
             choice = self.menu()
 
             if choice == '1':
@@ -312,9 +328,11 @@ class CLI:
                 drive_settings = self.config['folders_to_sync'][self.drive_label]
 
                 def init_drive_class():
-                    return Drive(self.config, drive_settings['local_path'], drive_settings['remote_folder_id'], self.google_drive, self.key_manager)
+                    storage, remote_folder_id = create_storage(drive_settings, self.google_drive)
+                    return Drive(self.config, drive_settings['local_path'], remote_folder_id, storage, self.key_manager)
 
                 self.drive = execute_with_spinner(init_drive_class, f"Connecting to {self.drive_label}")
+                startup.mark(f'connect:{self.drive_label}')
 
             if not self.drive:
                 print(f"{Fore.RED}Please select a drive first{Style.RESET_ALL}")
@@ -326,6 +344,12 @@ class CLI:
                 execute_with_spinner(self.drive.push, f"Pushing to {self.drive_label}")
             elif choice == '4':
                 ChatMenu(self.drive).display()
+            elif choice == '6':
+                print(f"{Style.DIM}Watching {self.drive_label} for changes, press Ctrl+C to stop{Style.RESET_ALL}")
+                try:
+                    WatchDaemon(self.drive).run()
+                except KeyboardInterrupt:
+                    print(f"{Style.DIM}Stopped watching {self.drive_label}{Style.RESET_ALL}")
                 
 
 
@@ -336,7 +360,8 @@ class CLI:
             '2': Fore.RED+'Pull',
             '3': Fore.GREEN+'Push',
             '4': Fore.YELLOW+'Chat',
-            '5': Style.DIM+'Settings'
+            '5': Style.DIM+'Settings',
+            '6': Fore.CYAN+'Watch'
         }
         rows = []
 
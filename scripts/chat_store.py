@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+import ujson as json
+
+
+class ChatStore:
+    """Local chat history in SQLite, indexed by peer, message id and timestamp.
+
+    Adding a message is a single insert instead of rewriting the whole history,
+    and reads only fetch the requested time range or page of messages.
+    """
+
+    def __init__(self, db_path:str) -> None:
+        self.db_path = db_path
+        # Refreshes run on a worker thread, so access is serialised with a lock instead
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'peer TEXT NOT NULL, '
+                'message_id TEXT NOT NULL, '
+                'timestamp REAL NOT NULL, '
+                'sender TEXT NOT NULL, '
+                'content TEXT NOT NULL, '
+                'PRIMARY KEY (peer, message_id))'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS messages_by_time ON messages (peer, timestamp)'
+            )
+
+    def add(self, peer:str, message_id:str, message:dict):
+        self.add_many([(peer, message_id, message)])
+
+    def add_many(self, messages:list[tuple[str, str, dict]]):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)',
+                [
+                    (peer, message_id, message['timestamp'], message['sender'], message['content'])
+                    for peer, message_id, message in messages
+                ]
+            )
+
+    def message_ids(self, peer:str) -> set[str]:
+        with self.lock:
+            rows = self.connection.execute('SELECT message_id FROM messages WHERE peer = ?', (peer,))
+            return {message_id for message_id, in rows}
+
+    def get_messages(self, peer:str, since:float=None, until:float=None, limit:int=None) -> dict[str, dict]:
+        """Messages exchanged with `peer` in `[since, until)`, oldest first
+
+        With `limit` only the newest `limit` messages of the range are returned.
+        """
+        query = 'SELECT message_id, timestamp, sender, content FROM messages WHERE peer = ?'
+        parameters = [peer]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            parameters.append(since)
+        if until is not None:
+            query += ' AND timestamp < ?'
+            parameters.append(until)
+        query += ' ORDER BY timestamp DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        return {
+            message_id: {"timestamp": timestamp, "content": content, "sender": sender}
+            for message_id, timestamp, sender, content in reversed(rows)
+        }
+
+    def peers(self) -> list[str]:
+        with self.lock:
+            return [peer for peer, in self.connection.execute('SELECT DISTINCT peer FROM messages')]
+
+    def import_json(self, path:str) -> int:
+        """Imports a `chat.json` history of the form `{peer: {message_id: message}}`"""
+        with open(path, 'rb') as f:
+            history:dict[str, dict[str, dict]] = json.loads(f.read())
+
+        messages = [
+            (peer, message_id, message)
+            for peer, peer_messages in history.items()
+            for message_id, message in peer_messages.items()
+        ]
+        self.add_many(messages)
+        return len(messages)
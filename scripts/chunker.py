@@ -0,0 +1,68 @@
+import random
+
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVERAGE_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+READ_SIZE = 8 * 1024 * 1024
+
+# Every byte value is mapped to one pseudo-random bit. The bits of the last few
+# bytes form the rolling fingerprint, and a chunk ends where it matches a fixed
+# pattern. Translating and searching both run in C, unlike a per-byte hash loop
+# in Python. The seed is fixed so boundaries are identical on every machine.
+_rng = random.Random(0xCEA5ED)
+_BIT_TABLE = bytes(_rng.getrandbits(1) for _ in range(256))
+_PATTERN = bytes(_rng.getrandbits(1) for _ in range(64))
+del _rng
+
+
+def _pattern(bits:int) -> bytes:
+    # Alternating ends guarantee that runs of identical bytes never match
+    return b'\x00' + _PATTERN[:bits-2] + b'\x01'
+
+
+def _find_boundary(fingerprint:bytes, end:int, average_size:int) -> int:
+    """Return the length of the chunk at the start of `fingerprint[:end]`"""
+    if end <= MIN_CHUNK_SIZE:
+        return end
+
+    # Normalized chunking: a stricter pattern before the average size and a looser one after it
+    bits = average_size.bit_length() - 1
+    normal = min(average_size, end)
+    for pattern, start, stop in (
+        (_pattern(bits + 2), MIN_CHUNK_SIZE, normal),
+        (_pattern(bits - 2), normal, end),
+    ):
+        position = fingerprint.find(pattern, start - len(pattern), stop)
+        if position != -1:
+            return position + len(pattern)
+    return end
+
+
+def iter_chunks(stream, average_size:int=AVERAGE_CHUNK_SIZE):
+    """Split a binary stream into content-defined chunks
+
+    Boundaries depend only on the bytes right before them, so inserting or
+    removing data in a file only changes the chunks around the edit.
+
+    Yields:
+        bytes: consecutive chunks between `MIN_CHUNK_SIZE` and `MAX_CHUNK_SIZE` long
+    """
+    buffer = b''
+    fingerprint = b''
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = stream.read(READ_SIZE)
+            eof = not data
+            buffer += data
+            fingerprint += data.translate(_BIT_TABLE)
+
+        if not buffer:
+            return
+
+        length = _find_boundary(fingerprint, min(len(buffer), MAX_CHUNK_SIZE), average_size)
+        yield buffer[:length]
+        buffer = buffer[length:]
+        fingerprint = fingerprint[length:]
@@ -0,0 +1,89 @@
+import bz2
+import lzma
+import zlib
+
+
+# Codec ids are stored in the flags byte of the stream header
+CODECS = {
+    'zlib': 1,
+    'bz2': 2,
+    'lzma': 3,
+}
+CODEC_MASK = 0x0F
+
+SAMPLE_SIZE = 256 * 1024
+# Data that doesn't shrink below this fraction of its size is stored as-is
+MAX_COMPRESSED_RATIO = 0.9
+BLOCK_SIZE = 1024 * 1024
+
+
+def _compressor(codec:str, level:int):
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor(level)
+    elif codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError(f"Unknown compression codec {codec}")
+
+
+def _decompressor(codec_id:int):
+    if codec_id == CODECS['zlib']:
+        return zlib.decompressobj()
+    elif codec_id == CODECS['bz2']:
+        return bz2.BZ2Decompressor()
+    elif codec_id == CODECS['lzma']:
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unknown compression codec id {codec_id}")
+
+
+def is_compressible(sample:bytes) -> bool:
+    """Cheap check with fast zlib on a sample, so already compressed media is skipped"""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_COMPRESSED_RATIO
+
+
+def compress_stream(source, destination, codec:str, level:int) -> int:
+    """Compresses `source` into `destination` block by block and returns the compressed size"""
+    compressor = _compressor(codec, level)
+    size = 0
+    while True:
+        block = source.read(BLOCK_SIZE)
+        if not block:
+            break
+        compressed = compressor.compress(block)
+        destination.write(compressed)
+        size += len(compressed)
+
+    compressed = compressor.flush()
+    destination.write(compressed)
+    return size + len(compressed)
+
+
+class DecompressingWriter:
+    """Write-only sink that decompresses everything written to it into `fileobj`"""
+
+    def __init__(self, fileobj, codec_id:int):
+        self.fileobj = fileobj
+        self.codec_id = codec_id
+        self.decompressor = _decompressor(codec_id)
+
+    def write(self, data:bytes) -> int:
+        length = len(data)
+        # Output is produced in bounded blocks so a small input can't expand in memory all at once
+        if self.codec_id == CODECS['zlib']:
+            while data:
+                self.fileobj.write(self.decompressor.decompress(data, BLOCK_SIZE))
+                data = self.decompressor.unconsumed_tail
+        else:
+            self.fileobj.write(self.decompressor.decompress(data, BLOCK_SIZE))
+            while not self.decompressor.needs_input and not self.decompressor.eof:
+                self.fileobj.write(self.decompressor.decompress(b'', BLOCK_SIZE))
+        return length
+
+    def finish(self):
+        if self.codec_id == CODECS['zlib']:
+            self.fileobj.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise ValueError("Compressed stream ended early")
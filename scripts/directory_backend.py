@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import StorageBackend
+
+
+ROOT_FOLDER_ID = '.'
+DEFAULT_WORKERS = 16
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# Uploads are written under this prefix and renamed into place once complete
+TEMP_PREFIX = '.partial-'
+
+
+class DirectoryBackend(StorageBackend):
+    """Keeps the archive in a directory, e.g. a local disk or a NAS share.
+
+    Ids are paths relative to `root_path`, so the archive can be copied to or
+    from Google Drive as is. Transfers are plain buffered file copies, and batch
+    calls are spread over `workers` threads to keep network shares busy.
+    """
+
+    def __init__(self, root_path:str, workers:int=DEFAULT_WORKERS, fsync:bool=True) -> None:
+        self.root_path = os.path.abspath(root_path)
+        self.workers = workers
+        self.fsync = fsync
+        self.root_folder_id = ROOT_FOLDER_ID
+        os.makedirs(self.root_path, exist_ok=True)
+
+    def _path(self, file_id:str) -> str:
+        path = os.path.normpath(os.path.join(self.root_path, file_id or ROOT_FOLDER_ID))
+        if path != self.root_path and not path.startswith(self.root_path + os.sep):
+            raise ValueError(f"Invalid id {file_id}")
+        return path
+
+    @staticmethod
+    def _child_id(name:str, parent_folder_id:str) -> str:
+        if name in ('', '.', '..') or '/' in name or os.sep in name:
+            raise ValueError(f"Invalid name {name}")
+        if not parent_folder_id or parent_folder_id == ROOT_FOLDER_ID:
+            return name
+        return f'{parent_folder_id}/{name}'
+
+    def _map(self, function, items:list) -> list:
+        def call(item):
+            try:
+                return function(*item)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            return list(executor.map(call, items))
+
+    def list_folder(self, folder_id:str) -> list[dict]:
+        with os.scandir(self._path(folder_id)) as entries:
+            return [
+                {"id": self._child_id(entry.name, folder_id), "name": entry.name, "is_folder": entry.is_dir()}
+                for entry in entries if not entry.name.startswith(TEMP_PREFIX)
+            ]
+
+    def create_folder(self, name:str, parent_folder_id:str=None) -> str:
+        folder_id = self._child_id(name, parent_folder_id)
+        os.makedirs(self._path(folder_id), exist_ok=True)
+        return folder_id
+
+    def _write(self, file_id:str, stream, chunksize:int=None):
+        path = self._path(file_id)
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, chunksize or COPY_BUFFER_SIZE)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def upload_stream(self, stream, name:str, parent_folder_id:str, mimetype:str='application/octet-stream', chunksize:int=None, session=None) -> str:
+        file_id = self._child_id(name, parent_folder_id)
+        self._write(file_id, stream, chunksize)
+        return file_id
+
+    def update_stream(self, file_id:str, stream, mimetype:str='application/octet-stream', chunksize:int=None, session=None) -> str:
+        if not os.path.isfile(self._path(file_id)):
+            raise FileNotFoundError(f"File {file_id} does not exist")
+        self._write(file_id, stream, chunksize)
+        return file_id
+
+    def download_to(self, file_id:str, stream, chunksize:int=None):
+        with open(self._path(file_id), 'rb') as f:
+            shutil.copyfileobj(f, stream, chunksize or COPY_BUFFER_SIZE)
+
+    def delete_file(self, file_id:str):
+        path = self._path(file_id)
+        if path == self.root_path:
+            raise ValueError("The root folder can't be deleted")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def create_folders(self, folders:list[tuple[str, str]]) -> list[str|Exception]:
+        return self._map(self.create_folder, folders)
+
+    def delete_files(self, file_ids:list[str]) -> list[Exception|None]:
+        return self._map(self.delete_file, [(file_id,) for file_id in file_ids])
@@ -1,6 +1,9 @@
 from cryptography.hazmat.primitives.asymmetric import rsa as _rsa
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import serialization, hashes, hmac
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidTag
 
 import os
 
@@ -8,12 +11,28 @@ from cryptography.fernet import Fernet
 import os
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 import hashlib
+from functools import lru_cache
+
+from compression import DecompressingWriter, CODEC_MASK
+
+# Prefix of messages made of an RSA-wrapped one-time key and a symmetric payload
+HYBRID_MAGIC = b'CEHY\x01'
 
 
 class RSA:
     def __init__(self):
         pass
 
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def load_public_key(public_pem:bytes):
+        return serialization.load_pem_public_key(public_pem)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def load_private_key(private_pem:bytes):
+        return serialization.load_pem_private_key(private_pem, password=None)
+
     @staticmethod
     def generate_key_pair():
         """
@@ -40,7 +59,9 @@ class RSA:
 
     @staticmethod
     def encrypt(plain_text:bytes, public_key):
-        public_key = serialization.load_pem_public_key(public_key)
+        """Encrypt at most ~446 bytes with RSA-OAEP. `public_key` is a PEM or a loaded key"""
+        if isinstance(public_key, bytes):
+            public_key = RSA.load_public_key(public_key)
         encrypted = public_key.encrypt(
             plain_text,
             padding.OAEP(
@@ -53,7 +74,8 @@ class RSA:
 
     @staticmethod
     def decrypt(cipher_text:bytes, private_key):
-        private_key = serialization.load_pem_private_key(private_key, password=None)
+        if isinstance(private_key, bytes):
+            private_key = RSA.load_private_key(private_key)
         decrypted = private_key.decrypt(
             cipher_text,
             padding.OAEP(
@@ -64,6 +86,29 @@ class RSA:
         )
         return decrypted
 
+    @staticmethod
+    def encrypt_hybrid(plain_text:bytes, public_key) -> bytes:
+        """
+        Encrypt data of any size for the owner of `public_key`.
+
+        A one-time Fernet key encrypts the data and only that key is wrapped with RSA-OAEP.
+        """
+        session_key = Fernet.generate_key()
+        wrapped_key = RSA.encrypt(session_key, public_key)
+        return HYBRID_MAGIC + len(wrapped_key).to_bytes(2, 'big') + wrapped_key + Fernet(session_key).encrypt(plain_text)
+
+    @staticmethod
+    def decrypt_hybrid(cipher_text:bytes, private_key) -> bytes:
+        """Decrypt the output of `encrypt_hybrid`, or a plain RSA-OAEP ciphertext from older versions"""
+        if not cipher_text.startswith(HYBRID_MAGIC):
+            return RSA.decrypt(cipher_text, private_key)
+
+        offset = len(HYBRID_MAGIC)
+        key_length = int.from_bytes(cipher_text[offset:offset+2], 'big')
+        offset += 2
+        session_key = RSA.decrypt(cipher_text[offset:offset+key_length], private_key)
+        return Fernet(session_key).decrypt(cipher_text[offset+key_length:])
+
 class AES:
     def __init__(self):
         pass
@@ -88,7 +133,218 @@ class AES:
 
     def decrypt(self, cipher_text:bytes, key:str):
         return Fernet(key).decrypt(cipher_text)
-    
+
+
+STREAM_MAGIC = b'CEASTR'
+STREAM_VERSION = 1
+STREAM_HEADER_LENGTH = len(STREAM_MAGIC) + 1 + 1 + 4 + 7
+STREAM_RECORD_SIZE = 1024 * 1024
+STREAM_TAG_LENGTH = 16
+
+
+class StreamDecryptionError(Exception):
+    pass
+
+
+def _stream_key(key:bytes) -> AESGCM:
+    """Derive the AES-GCM key used for streams from an archive (Fernet) key"""
+    derived = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'ceased stream v1'
+    ).derive(urlsafe_b64decode(key))
+    return AESGCM(derived)
+
+
+def _stream_nonce(prefix:bytes, index:int, final:bool) -> bytes:
+    return prefix + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+
+def stream_length(size:int, record_size:int=STREAM_RECORD_SIZE) -> int:
+    """Length of `size` bytes of plaintext in the chunked stream format"""
+    return STREAM_HEADER_LENGTH + size + max(1, -(-size // record_size)) * STREAM_TAG_LENGTH
+
+
+class EncryptingReader:
+    """Seekable, read-only view of a file encrypted in the chunked stream format.
+
+    The plaintext is split into records of `record_size` bytes, each sealed
+    with AES-GCM under a nonce made of a random per-stream prefix, the record
+    index and a final-record flag, so records can not be reordered or
+    truncated. Only the record currently being read is held in memory, which
+    lets uploads stream straight from disk.
+    """
+
+    def __init__(self, fileobj, key:bytes, size:int, record_size:int=STREAM_RECORD_SIZE, nonce_prefix:bytes=None, flags:int=0):
+        self.fileobj = fileobj
+        self.aead = _stream_key(key)
+        self.size = size
+        self.record_size = record_size
+        self.nonce_prefix = nonce_prefix or os.urandom(7)
+        self.header = (
+            STREAM_MAGIC
+            + bytes([STREAM_VERSION, flags])
+            + record_size.to_bytes(4, 'big')
+            + self.nonce_prefix
+        )
+        self.record_count = max(1, -(-size // record_size))
+        self.length = stream_length(size, record_size)
+        self.position = 0
+
+        self._record_index = None
+        self._record = None
+        self._record_digests = {}
+
+    def _read_record(self, index:int) -> bytes:
+        start = index * self.record_size
+        expected = min(self.record_size, self.size - start)
+        self.fileobj.seek(start)
+        plain_text = self.fileobj.read(expected)
+        if len(plain_text) != expected:
+            raise IOError("File changed while it was being encrypted")
+
+        # Re-encrypting a record under the same nonce is only safe for identical plaintext
+        digest = hash_sha256(plain_text)
+        if self._record_digests.setdefault(index, digest) != digest:
+            raise IOError("File changed while it was being encrypted")
+        return plain_text
+
+    def records_digest(self, offset:int) -> str:
+        """Digest of the plaintext of every record that begins within the first `offset` bytes of the stream
+
+        Records that weren't read yet are read for it, so a resumed upload can check
+        that the bytes the server already has were made from the same plaintext.
+        """
+        count = min(self.record_count, -(-max(0, offset - STREAM_HEADER_LENGTH) // (self.record_size + STREAM_TAG_LENGTH)))
+        for index in range(count):
+            if index not in self._record_digests:
+                self._read_record(index)
+        return hash_sha256(b''.join(self._record_digests[index] for index in range(count))).hex()
+
+    def _encrypt_record(self, index:int) -> bytes:
+        if index == self._record_index:
+            return self._record
+
+        plain_text = self._read_record(index)
+        final = index == self.record_count - 1
+        nonce = _stream_nonce(self.nonce_prefix, index, final)
+        self._record = self.aead.encrypt(nonce, plain_text, self.header)
+        self._record_index = index
+        return self._record
+
+    def read(self, size:int=-1) -> bytes:
+        if size is None or size < 0:
+            size = self.length - self.position
+
+        pieces = []
+        while size > 0 and self.position < self.length:
+            if self.position < STREAM_HEADER_LENGTH:
+                piece = self.header[self.position:self.position+size]
+            else:
+                offset = self.position - STREAM_HEADER_LENGTH
+                index = offset // (self.record_size + STREAM_TAG_LENGTH)
+                record_offset = offset - index * (self.record_size + STREAM_TAG_LENGTH)
+                piece = self._encrypt_record(index)[record_offset:record_offset+size]
+
+            pieces.append(piece)
+            self.position += len(piece)
+            size -= len(piece)
+
+        return b''.join(pieces)
+
+    def seek(self, offset:int, whence:int=os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+
+class DecryptingWriter:
+    """Write-only sink that decrypts a stream record by record into `fileobj`.
+
+    Objects that do not start with the stream header are treated as legacy
+    Fernet tokens, which have to be buffered and decrypted in one piece. When
+    the header flags name a compression codec the plaintext is decompressed
+    on the way out.
+    """
+
+    def __init__(self, fileobj, key:bytes):
+        self.fileobj = fileobj
+        self.decompressor = None
+        self.key = key
+        self.aead = None
+        self.header = None
+        self.legacy = False
+        self.buffer = bytearray()
+        self.index = 0
+
+    def _parse_header(self) -> bool:
+        if len(self.buffer) < STREAM_HEADER_LENGTH:
+            if not STREAM_MAGIC.startswith(bytes(self.buffer[:len(STREAM_MAGIC)])):
+                self.legacy = True
+            return False
+
+        header = bytes(self.buffer[:STREAM_HEADER_LENGTH])
+        if not header.startswith(STREAM_MAGIC):
+            self.legacy = True
+            return False
+        if header[len(STREAM_MAGIC)] != STREAM_VERSION:
+            raise StreamDecryptionError(f"Unsupported stream version {header[len(STREAM_MAGIC)]}")
+
+        self.header = header
+        self.flags = header[len(STREAM_MAGIC)+1]
+        if self.flags & CODEC_MASK:
+            self.decompressor = DecompressingWriter(self.fileobj, self.flags & CODEC_MASK)
+        self.record_size = int.from_bytes(header[len(STREAM_MAGIC)+2:len(STREAM_MAGIC)+6], 'big')
+        self.nonce_prefix = header[len(STREAM_MAGIC)+6:]
+        self.aead = _stream_key(self.key)
+        del self.buffer[:STREAM_HEADER_LENGTH]
+        return True
+
+    def _decrypt_record(self, record:bytes, final:bool):
+        nonce = _stream_nonce(self.nonce_prefix, self.index, final)
+        try:
+            plain_text = self.aead.decrypt(nonce, record, self.header)
+        except InvalidTag:
+            raise StreamDecryptionError(f"Record {self.index} failed authentication")
+        (self.decompressor or self.fileobj).write(plain_text)
+        self.index += 1
+
+    def write(self, data:bytes) -> int:
+        self.buffer += data
+        if self.legacy or (self.header is None and not self._parse_header()):
+            return len(data)
+
+        record_length = self.record_size + STREAM_TAG_LENGTH
+        # A full record is only known not to be the last one once more data follows it
+        offset = 0
+        while len(self.buffer) - offset > record_length:
+            self._decrypt_record(bytes(self.buffer[offset:offset+record_length]), final=False)
+            offset += record_length
+        del self.buffer[:offset]
+        return len(data)
+
+    def finish(self):
+        if self.legacy or self.header is None:
+            self.fileobj.write(aes.decrypt(bytes(self.buffer), self.key))
+        else:
+            self._decrypt_record(bytes(self.buffer), final=True)
+            if self.decompressor:
+                self.decompressor.finish()
+        self.buffer = bytearray()
+
 
 
 def hash_md5(data: bytes) -> bytes:
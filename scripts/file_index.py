@@ -0,0 +1,99 @@
+import os
+import time
+import ujson as json
+
+
+# Files modified this close to the time they were hashed may still change
+# within the same mtime tick, so their digest is not trusted until they are
+# hashed again later. Saving the index drops such entries for the same reason.
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class FileIndex:
+    """Persistent cache of file digests keyed by path.
+
+    Each entry stores the `size`, `mtime_ns` and `inode` of the file at the
+    time it was hashed together with the digest. As long as the stat tuple is
+    unchanged the cached digest is reused and the file is never read.
+    """
+
+    def __init__(self, local_path:str, index_path:str) -> None:
+        self.local_path = local_path
+        self.index_path = index_path
+        self.entries:dict[str, dict] = {}
+        # When the entries updated since loading were hashed, saved entries are never racy
+        self.hashed_ns:dict[str, int] = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                self.entries = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.hashed_ns = {}
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        now = time.time_ns()
+        entries = {
+            path: entry for path, entry in self.entries.items()
+            if now - entry['mtime_ns'] > RACY_WINDOW_NS
+        }
+
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(entries).encode())
+        os.replace(temp_path, self.index_path)
+        self.dirty = False
+
+    @staticmethod
+    def _stat_key(stat:os.stat_result) -> dict:
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "inode": stat.st_ino,
+        }
+
+    def stat(self, path:str) -> os.stat_result:
+        return os.stat(os.path.join(self.local_path, path))
+
+    def lookup(self, path:str, stat:os.stat_result) -> str|None:
+        """Return the cached digest of `path` if its stat tuple is unchanged and it wasn't hashed right after a change"""
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+
+        hashed_ns = self.hashed_ns.get(path)
+        if hashed_ns is not None and hashed_ns - entry['mtime_ns'] <= RACY_WINDOW_NS:
+            return None
+
+        if (
+            entry['size'] != stat.st_size
+            or entry['mtime_ns'] != stat.st_mtime_ns
+            or entry['inode'] != stat.st_ino
+        ):
+            return None
+        return entry['digest']
+
+    def update(self, path:str, stat:os.stat_result, digest:str):
+        entry = self._stat_key(stat)
+        entry['digest'] = digest
+        self.hashed_ns[path] = time.time_ns()
+        if self.entries.get(path) != entry:
+            self.entries[path] = entry
+            self.dirty = True
+
+    def prune(self, paths:set[str]):
+        """Drop entries for files that no longer exist"""
+        stale = [path for path in self.entries if path not in paths]
+        for path in stale:
+            del self.entries[path]
+            self.hashed_ns.pop(path, None)
+        if stale:
+            self.dirty = True
@@ -1,25 +1,88 @@
 import os
+import ssl
+import time
+import json
 import tempfile
-import io
+import threading
+import weakref
+import http.client
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from functools import lru_cache
+
+# The other Google client modules take a few hundred milliseconds to import, so they
+# are imported where they are first needed. Drives stored elsewhere never load them.
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, BatchHttpRequest, MediaIoBaseDownload
 
-from google.auth.exceptions import RefreshError
+import startup
+from storage import StorageBackend, ChangesExpiredError, UploadSessionExpiredError
+from scheduler import AdaptiveScheduler, THROTTLED, RETRY, DEFAULT_MAX_CONCURRENCY
+
+# Resumable transfers move this many bytes per request, which bounds the memory
+# held by a single upload or download. Must be a multiple of 256 KiB.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# The Drive batch endpoint accepts at most this many calls per request
+BATCH_SIZE = 100
+
+RETRY_STATUSES = (500, 502, 503, 504)
+THROTTLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+NETWORK_ERRORS = (ConnectionError, TimeoutError, ssl.SSLError, http.client.HTTPException)
+
+
+def classify_error(error:Exception) -> str|None:
+    """Tells the scheduler whether a failed call was throttled, can be retried, or failed for good"""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        details = error.error_details if isinstance(error.error_details, list) else []
+        reasons = {detail.get('reason') for detail in details if isinstance(detail, dict)}
+        if status == 429 or (status == 403 and reasons & set(THROTTLE_REASONS)):
+            return THROTTLED
+        if status in RETRY_STATUSES:
+            return RETRY
+        return None
+    # Loaded with the first API client, before any call can fail
+    import httplib2
+    if isinstance(error, NETWORK_ERRORS + (httplib2.HttpLib2Error,)):
+        return RETRY
+    return None
+
+
+def retry_after(error:Exception) -> float|None:
+    if isinstance(error, HttpError):
+        try:
+            return float(error.resp.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+@lru_cache(maxsize=None)
+def _discovery_document() -> dict|None:
+    """The Drive v3 discovery document bundled with googleapiclient, parsed once for all API clients"""
+    from googleapiclient import discovery_cache
+    document = discovery_cache.get_static_doc('drive', 'v3')
+    return json.loads(document) if document else None
+
 
 class CredentialsNotFoundError(Exception):
     def __init__(self, path:str) -> None:
         self.message = f"Credentials not found in {os.path.abspath(path)}"
         super().__init__(self.message)
 
-class GoogleDrive:
+class _ServiceLease:
+    def __init__(self, service) -> None:
+        self.service = service
+
+class GoogleDrive(StorageBackend):
+    resumable_uploads = True
+
     def __init__(self,
         creds_path:str="auth/credentials.json",
-        token_path:str="auth/token.json"
+        token_path:str="auth/token.json",
+        max_concurrency:int=DEFAULT_MAX_CONCURRENCY
     ) -> None:
         self.SCOPES = ["https://www.googleapis.com/auth/drive"]
         self.creds_path = creds_path
@@ -29,12 +92,19 @@ class GoogleDrive:
         if not os.path.exists(self.creds_path):
             raise CredentialsNotFoundError(self.creds_path)
         self.creds = None
-        self.auth()
-
-
-
+        self._thread_local = threading.local()
+        self._idle_services = []
+        self._creds_lock = threading.Lock()
+        # Shared by every call, so all threads together stay within the quota
+        self.scheduler = AdaptiveScheduler(classify_error, retry_after, max_concurrency=max_concurrency)
+        # Credentials are loaded by the first API call
 
     def auth(self):
+        from google.auth.transport.requests import Request
+        from google.auth.exceptions import RefreshError
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         if os.path.exists(self.token_path):
             self.creds = Credentials.from_authorized_user_file(self.token_path, self.SCOPES)
         
@@ -55,55 +125,123 @@ class GoogleDrive:
             os.remove(self.token_path)
             self.auth()
 
-    def upload_file(self, file_data: bytes, name:str, parent_folder_id: str, mimetype:str='application/octet-stream'):
-        try:
-            # Use an in-memory bytes buffer instead of a temporary file
-            file_buffer = io.BytesIO(file_data)
-            service = build('drive', 'v3', credentials=self.creds)
-            
-            file_metadata = {
-                'name': name,
-            }
+    def _refresh_creds(self):
+        # Credentials are shared by every thread, so only one of them loads or refreshes them
+        with self._creds_lock:
+            if self.creds is None:
+                self.auth()
+                startup.mark('credentials')
+            elif not self.creds.valid:
+                from google.auth.transport.requests import Request
+                self.creds.refresh(Request())
+                with open(self.token_path, "w") as token:
+                    token.write(self.creds.to_json())
 
-            if parent_folder_id:
-                file_metadata["parents"] = [parent_folder_id]
+    @property
+    def service(self):
+        """Drive API client leased to the calling thread.
 
-            media = MediaIoBaseUpload(file_buffer, mimetype=mimetype, resumable=True)
+        httplib2 is not thread-safe, so every thread gets a client of its own. When
+        the thread exits the client goes back to the pool together with its
+        keep-alive connection and is handed to the next new thread.
+        """
+        if self.creds is None or not self.creds.valid:
+            self._refresh_creds()
 
-            # Perform the upload
-            file = (
-                service.files()
-                .create(body=file_metadata, media_body=media, fields="id")
-                .execute()
-            )
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            file = None
+        lease = getattr(self._thread_local, 'lease', None)
+        if lease is None:
+            try:
+                service = self._idle_services.pop()
+            except IndexError:
+                service = self._build_service()
 
-        # print(f'File uploaded: {name}')
+            lease = _ServiceLease(service)
+            weakref.finalize(lease, self._idle_services.append, service)
+            self._thread_local.lease = lease
+        return lease.service
 
-        return file.get("id")
+    def _build_service(self):
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build, build_from_document
 
-    def download_file(self, file_id) -> bytes:
-        try:
-            # create drive api client
-            service = build("drive", "v3", credentials=self.creds)
+        http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        document = _discovery_document()
+        if document is None:
+            return build('drive', 'v3', http=http)
+        return build_from_document(document, http=http)
 
+    @property
+    def concurrency(self) -> int:
+        """Number of API calls currently allowed in flight"""
+        return self.scheduler.concurrency
 
-            # pylint: disable=maybe-no-member
-            request = service.files().get_media(fileId=file_id)
-            file = io.BytesIO()
-            downloader = MediaIoBaseDownload(file, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                # print(f"Download {int(status.progress() * 100)}.")
+    def _execute(self, name:str, request):
+        return self.scheduler.run(name, request.execute)
 
-        except HttpError as error:
-            print(f"An error occurred: {error}")
+    def _run_upload(self, request, name:str, session=None) -> dict:
+        """Drives a resumable upload request to completion, resuming `session` if it has one"""
+        if session is not None and session.uri:
+            request.resumable_uri = session.uri
+            # Makes the first request ask the server how many bytes it already has
+            request._in_error_state = True
+
+        try:
             file = None
+            while file is None:
+                _, file = self.scheduler.run('upload_chunk', request.next_chunk)
+                if session is not None and file is None:
+                    session.checkpoint(request.resumable_uri, request.resumable_progress)
+        except HttpError as error:
+            if session is not None and session.uri and error.resp.status in (404, 410):
+                raise UploadSessionExpiredError(name)
+            raise
+        return file
+
+    def upload_stream(self, stream, name:str, parent_folder_id: str, mimetype:str='application/octet-stream', chunksize:int=DEFAULT_CHUNK_SIZE, session=None):
+        """Uploads a seekable file-like object, sending at most `chunksize` bytes per request
+
+        With an `UploadSession` the upload continues from the last byte the server
+        confirmed, and the session is checkpointed after every chunk.
+        """
+        from googleapiclient.http import MediaIoBaseUpload
+        service = self.service
+        
+        file_metadata = {
+            'name': name,
+        }
+
+        if parent_folder_id:
+            file_metadata["parents"] = [parent_folder_id]
+
+        media = MediaIoBaseUpload(stream, mimetype=mimetype, chunksize=chunksize, resumable=True)
+
+        request = service.files().create(body=file_metadata, media_body=media, fields="id")
+        file = self._run_upload(request, name, session)
+
+        # print(f'File uploaded: {name}')
+
+        return file.get("id")
+
+    def update_stream(self, file_id:str, stream, mimetype:str='application/octet-stream', chunksize:int=DEFAULT_CHUNK_SIZE, session=None):
+        """Replaces the content of an existing file, keeping its id and revision history"""
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(stream, mimetype=mimetype, chunksize=chunksize, resumable=True)
+        request = self.service.files().update(fileId=file_id, media_body=media, fields="id")
+        return self._run_upload(request, file_id, session).get("id")
+
+    def download_to(self, file_id, stream, chunksize:int=DEFAULT_CHUNK_SIZE):
+        """Downloads a file into a writable file-like object, `chunksize` bytes at a time"""
+        from googleapiclient.http import MediaIoBaseDownload
+        service = self.service
 
-        return file.getvalue()
+        # pylint: disable=maybe-no-member
+        request = service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(stream, request, chunksize=chunksize)
+        done = False
+        while done is False:
+            status, done = self.scheduler.run('download_chunk', downloader.next_chunk)
+            # print(f"Download {int(status.progress() * 100)}.")
 
     def search_file(self, query:str, fields:list=["id", "name"]) -> list[dict]:
         """Searches drive for files
@@ -114,59 +252,146 @@ class GoogleDrive:
         Returns:
             list[dict]: list of files
         """
-        try:
-            # create drive api client
-            service = build("drive", "v3", credentials=self.creds)
-            fields = "nextPageToken, files(" + ",".join(field for field in fields) + ")"
-            files = []
-            page_token = None
-            while True:
-                # pylint: disable=maybe-no-member
-                response = (
-                    service.files()
-                    .list(
-                        q=query,
-                        spaces="drive",
-                        fields=fields,
-                        pageToken=page_token,
-                    )
-                    .execute()
+        service = self.service
+        fields = "nextPageToken, files(" + ",".join(field for field in fields) + ")"
+        files = []
+        page_token = None
+        while True:
+            # pylint: disable=maybe-no-member
+            response = self._execute('list',
+                service.files()
+                .list(
+                    q=query,
+                    spaces="drive",
+                    fields=fields,
+                    pageToken=page_token,
                 )
-                files.extend(response.get("files", []))
-                page_token = response.get("nextPageToken", None)
-                if page_token is None:
-                    break
-
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            files = None
+            )
+            files.extend(response.get("files", []))
+            page_token = response.get("nextPageToken", None)
+            if page_token is None:
+                break
 
         return files
 
-    def create_folder(self, name:str, parent_folder_id:str=None):
-        try:
-            service = build("drive", "v3", credentials=self.creds)
-            file_metadata = {
-                "name": name,
-                "mimeType": "application/vnd.google-apps.folder",
-            }
+    def list_folder(self, folder_id:str) -> list[dict]:
+        files = self.search_file(f'parents in "{folder_id}" and trashed=false', ['id', 'name', 'mimeType'])
+        return [
+            {"id": file['id'], "name": file['name'], "is_folder": file['mimeType'] == FOLDER_MIME_TYPE}
+            for file in files
+        ]
 
-            if parent_folder_id:
-                file_metadata["parents"] = [parent_folder_id]
+    def _folder_metadata(self, name:str, parent_folder_id:str=None) -> dict:
+        file_metadata = {
+            "name": name,
+            "mimeType": FOLDER_MIME_TYPE,
+        }
 
-            file = service.files().create(body=file_metadata, fields="id").execute()
+        if parent_folder_id:
+            file_metadata["parents"] = [parent_folder_id]
+        return file_metadata
 
+    def create_folder(self, name:str, parent_folder_id:str=None):
+        service = self.service
+        file_metadata = self._folder_metadata(name, parent_folder_id)
 
-            return file.get("id")
+        file = self._execute('create_folder', service.files().create(body=file_metadata, fields="id"))
+
+        return file.get("id")
 
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return None
-        
     def delete_file(self, file_id:str):
         try:
-            service = build("drive", "v3", credentials=self.creds)
-            service.files().delete(fileId=file_id).execute()
+            service = self.service
+            self._execute('delete', service.files().delete(fileId=file_id))
         except HttpError as error:
-            print(f"An error occurred: {error}")
-            
\ No newline at end of file
+            # Already gone is as good as deleted
+            if error.resp.status == 404:
+                return
+            raise
+
+    def execute_batch(self, requests:list) -> list:
+        """Executes API requests in batches of up to `BATCH_SIZE` calls
+
+        Calls in a batch that are throttled or fail transiently are sent again in
+        a later batch, after the same backoff as any other call.
+
+        Returns:
+            list: the response of each request, or the `HttpError` it failed with, in request order
+        """
+        results = [None] * len(requests)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception if exception is not None else response
+
+        pending = list(range(len(requests)))
+        attempt = 0
+        while pending:
+            for start in range(0, len(pending), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for i in pending[start:start+BATCH_SIZE]:
+                    batch.add(requests[i], request_id=str(i))
+                self.scheduler.run('batch', batch.execute)
+
+            failures = {i: classify_error(results[i]) for i in pending if isinstance(results[i], Exception)}
+            pending = [i for i, kind in failures.items() if kind is not None]
+            if not pending or attempt >= self.scheduler.max_retries:
+                break
+            if THROTTLED in failures.values():
+                self.scheduler.throttled()
+            time.sleep(self.scheduler.backoff(attempt))
+            attempt += 1
+
+        return results
+
+    def delete_files(self, file_ids:list[str]) -> list[HttpError|None]:
+        files = self.service.files()
+        results = self.execute_batch([files.delete(fileId=file_id) for file_id in file_ids])
+        return [
+            result if isinstance(result, HttpError) and result.resp.status != 404 else None
+            for result in results
+        ]
+
+    def create_folders(self, folders:list[tuple[str, str]]) -> list[str|HttpError]:
+        """Creates `(name, parent_folder_id)` folders and returns their ids"""
+        files = self.service.files()
+        results = self.execute_batch([
+            files.create(body=self._folder_metadata(name, parent_folder_id), fields="id")
+            for name, parent_folder_id in folders
+        ])
+        return [result if isinstance(result, HttpError) else result.get("id") for result in results]
+
+    def get_start_page_token(self) -> str:
+        return self._execute('get_start_page_token', self.service.changes().getStartPageToken())["startPageToken"]
+
+    def list_changes(self, page_token:str, fields:list=["id", "name", "mimeType", "parents", "trashed"]) -> tuple[list[dict], str]:
+        """Lists every change made since `page_token`
+
+        Returns:
+            tuple[list[dict], str]: the changes and the page token to continue from next time
+        """
+        changes = []
+        fields = "nextPageToken, newStartPageToken, changes(fileId, removed, file(" + ",".join(fields) + "))"
+        while True:
+            try:
+                response = self._execute('list_changes',
+                    self.service.changes()
+                    .list(
+                        pageToken=page_token,
+                        spaces="drive",
+                        includeRemoved=True,
+                        pageSize=1000,
+                        fields=fields,
+                    )
+                )
+            except HttpError as error:
+                if error.resp.status in (400, 404, 410):
+                    raise ChangesExpiredError(page_token)
+                raise
+
+            for change in response.get("changes", []):
+                if change.get("file"):
+                    change["file"]["is_folder"] = change["file"].get("mimeType") == FOLDER_MIME_TYPE
+                changes.append(change)
+            if "newStartPageToken" in response:
+                return changes, response["newStartPageToken"]
+            page_token = response["nextPageToken"]
@@ -0,0 +1,154 @@
+import os
+import hashlib
+
+from base64 import urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_ALGORITHM = 'md5'
+ALGORITHMS = ('md5', 'blake2b')
+# Digests without a prefix come from versions that only knew md5
+LEGACY_ALGORITHM = 'md5'
+BLAKE2B_DIGEST_SIZE = 32
+DEFAULT_WORKERS = min(32, os.cpu_count() or 1)
+# Bytes handed to the hash function at a time, hashlib releases the GIL for each update.
+# Larger files are read block by block into one reused buffer
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def algorithm_of(digest:str) -> str:
+    """Returns the algorithm a manifest digest was computed with"""
+    algorithm, separator, _ = digest.partition(':')
+    return algorithm if separator else LEGACY_ALGORITHM
+
+
+def format_digest(algorithm:str, file_hash) -> str:
+    digest = urlsafe_b64encode(file_hash.digest()).decode()
+    return digest if algorithm == LEGACY_ALGORITHM else f'{algorithm}:{digest}'
+
+
+def _hash_blocks(fileobj, hashes):
+    """Feeds the rest of `fileobj` to every hash in `hashes`, one block at a time"""
+    # Not mmap: a file truncated while mapped kills the process with SIGBUS
+    block = bytearray(BLOCK_SIZE)
+    with memoryview(block) as view:
+        while length := fileobj.readinto(block):
+            for file_hash in hashes:
+                file_hash.update(view[:length])
+
+
+class HashingReader:
+    """Read-only file wrapper that hashes the bytes read through it.
+
+    Bytes are hashed in file order, and ranges read again after a seek back,
+    e.g. when an upload chunk is retried, are only hashed once. `digests` is set
+    once the last byte is hashed. A read that skips ahead leaves a gap, and
+    `digests` stays `None`.
+    """
+
+    def __init__(self, fileobj, size:int, hashes:dict) -> None:
+        self.fileobj = fileobj
+        self.size = size
+        self.hashes = hashes
+        self.position = fileobj.tell()
+        self.hashed = 0
+        self.digests:dict[str, str] = None
+        self._gap = False
+
+    def read(self, size:int=-1) -> bytes:
+        data = self.fileobj.read(size)
+        start, self.position = self.position, self.position + len(data)
+
+        if start > self.hashed:
+            self._gap = True
+        elif self.position > self.hashed and not self._gap:
+            piece = data if start == self.hashed else data[self.hashed-start:]
+            for file_hash in self.hashes.values():
+                file_hash.update(piece)
+            self.hashed = self.position
+
+        if self.digests is None and not self._gap and self.hashed >= self.size:
+            self.digests = {algorithm: format_digest(algorithm, file_hash) for algorithm, file_hash in self.hashes.items()}
+        return data
+
+    def seek(self, offset:int, whence:int=os.SEEK_SET) -> int:
+        self.position = self.fileobj.seek(offset, whence)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+
+class HashingEngine:
+    """Computes the digests that identify file contents in the manifest.
+
+    Files are spread over `workers` threads. Small files are read in one call,
+    larger ones are read into one buffer and hashed block by block, so a file is
+    never copied into memory as a whole.
+
+    md5 digests are stored as is for compatibility. Other algorithms prefix the
+    digest with their name, e.g. `blake2b:...`. BLAKE2 is keyed with `key`,
+    so its digests can't be matched against known files without the archive key.
+    """
+
+    def __init__(self, algorithm:str=DEFAULT_ALGORITHM, key:bytes=None, workers:int=DEFAULT_WORKERS) -> None:
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm}")
+        self.algorithm = algorithm
+        self.key = key or b''
+        self.workers = workers
+
+    def new_hash(self, algorithm:str):
+        if algorithm == 'blake2b':
+            return hashlib.blake2b(key=self.key, digest_size=BLAKE2B_DIGEST_SIZE)
+        elif algorithm == 'md5':
+            return hashlib.md5()
+        raise ValueError(f"Unknown hash algorithm {algorithm}")
+
+    def digest_file(self, path:str, algorithm:str=None) -> str:
+        algorithm = algorithm or self.algorithm
+        file_hash = self.new_hash(algorithm)
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < BLOCK_SIZE:
+                file_hash.update(f.read())
+            else:
+                _hash_blocks(f, [file_hash])
+
+        return format_digest(algorithm, file_hash)
+
+    def digest_stream(self, fileobj, algorithms) -> dict[str, str]:
+        """Hashes the rest of `fileobj` with each of `algorithms` in a single pass"""
+        hashes = {algorithm: self.new_hash(algorithm) for algorithm in algorithms}
+        _hash_blocks(fileobj, hashes.values())
+        return {algorithm: format_digest(algorithm, file_hash) for algorithm, file_hash in hashes.items()}
+
+    def digest_bytes(self, data:bytes, algorithm:str=None) -> str:
+        algorithm = algorithm or self.algorithm
+        file_hash = self.new_hash(algorithm)
+        file_hash.update(data)
+        return format_digest(algorithm, file_hash)
+
+    def reader(self, fileobj, size:int, algorithms) -> HashingReader:
+        """Wraps `fileobj` so reading it computes its digest with each of `algorithms`"""
+        return HashingReader(fileobj, size, {algorithm: self.new_hash(algorithm) for algorithm in algorithms})
+
+    def digest_files(self, paths:list[str], algorithm:str=None) -> dict[str, str|Exception]:
+        """Hashes `paths` in parallel and returns the digest of each, or the error it failed with"""
+        def digest(path:str) -> str|Exception:
+            try:
+                return self.digest_file(path, algorithm)
+            except Exception as e:
+                return e
+
+        if len(paths) <= 1:
+            return {path: digest(path) for path in paths}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(paths, executor.map(digest, paths)))
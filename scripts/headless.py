@@ -0,0 +1,118 @@
+import sys
+import time
+import argparse
+import ujson as json
+
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+import startup
+from key_manager import KeyManager
+from google_drive import GoogleDrive
+from scheduler import DEFAULT_MAX_CONCURRENCY
+from sync import Drive, create_storage
+from config_loader import load_config
+
+
+DEFAULT_JOBS = 4
+ACTIONS = ('push', 'pull', 'sync')
+
+
+def sync_drive(config:dict, label:str, action:str, google_drive:GoogleDrive, key_manager:KeyManager) -> dict:
+    """Runs `action` on one drive of `folders_to_sync` and returns its summary"""
+    summary = {'status': 'ok'}
+    start = time.monotonic()
+    try:
+        drive_settings = config['folders_to_sync'][label]
+        storage, remote_folder_id = create_storage(drive_settings, google_drive)
+        drive = Drive(config, drive_settings['local_path'], remote_folder_id, storage, key_manager)
+        summary['connect_seconds'] = round(time.monotonic() - start, 3)
+        startup.mark(f'connect:{label}')
+
+        # Same order as watch mode: local changes go up before the archive is mirrored back
+        if action in ('push', 'sync'):
+            step_start = time.monotonic()
+            summary['push'] = drive.push()
+            summary['push']['seconds'] = round(time.monotonic() - step_start, 3)
+        if action == 'sync' and summary['push']['failed']:
+            # Pulling now would revert or delete the local changes that didn't make it up
+            print(f"Not pulling drive `{label}`, some files could not be pushed")
+            summary['pull_skipped'] = True
+        elif action in ('pull', 'sync'):
+            step_start = time.monotonic()
+            summary['pull'] = drive.pull()
+            summary['pull']['seconds'] = round(time.monotonic() - step_start, 3)
+
+        if any(summary.get(step, {}).get('failed') for step in ('push', 'pull')):
+            summary['status'] = 'failed_files'
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = f"{type(e).__name__}: {e}"
+        print(f"Error syncing drive `{label}`: {summary['error']}")
+
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    return summary
+
+
+def sync_drives(config:dict, labels:list[str], action:str, jobs:int=DEFAULT_JOBS, max_concurrency:int=DEFAULT_MAX_CONCURRENCY) -> dict:
+    """Runs `action` on every drive in `labels`, `jobs` drives at a time
+
+    All Google Drive backed drives share one `GoogleDrive`, so its connection
+    pool and its limit of `max_concurrency` API calls in flight are global.
+    """
+    start = time.monotonic()
+    key_manager = KeyManager('keys/')
+    google_drive = None
+    if any(config['folders_to_sync'][label].get('backend', 'google_drive') == 'google_drive' for label in labels):
+        google_drive = GoogleDrive(max_concurrency=max_concurrency)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            label: executor.submit(sync_drive, config, label, action, google_drive, key_manager)
+            for label in labels
+        }
+    drives = {label: future.result() for label, future in futures.items()}
+
+    return {
+        'action': action,
+        'status': 'ok' if all(drive['status'] == 'ok' for drive in drives.values()) else 'failed',
+        'seconds': round(time.monotonic() - start, 3),
+        'drives': drives
+    }
+
+
+def main(argv:list[str]=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='ceased',
+        description="Pushes, pulls or syncs drives from `folders_to_sync` without prompts and prints a JSON summary."
+    )
+    parser.add_argument('action', choices=ACTIONS, help="sync pushes local changes and then pulls the archive")
+    parser.add_argument('drives', nargs='*', help="labels of the drives in config.yaml")
+    parser.add_argument('--all', action='store_true', help="every drive in config.yaml")
+    parser.add_argument('--config', default='config.yaml', help="path of config.yaml")
+    parser.add_argument('--jobs', type=int, default=None, help=f"drives synced at the same time (default {DEFAULT_JOBS})")
+    parser.add_argument('--max-concurrency', type=int, default=None, help=f"Google Drive calls in flight across all drives (default {DEFAULT_MAX_CONCURRENCY})")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    startup.mark('config')
+    if args.all == bool(args.drives):
+        parser.error("name one or more drives, or pass --all")
+    labels = list(config['folders_to_sync']) if args.all else args.drives
+    unknown = [label for label in labels if label not in config['folders_to_sync']]
+    if unknown:
+        parser.error(f"unknown drives: {', '.join(unknown)}")
+
+    jobs = args.jobs or config.get('sync_jobs', DEFAULT_JOBS)
+    max_concurrency = args.max_concurrency or config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+
+    # Progress goes to stderr so stdout only carries the summary
+    with redirect_stdout(sys.stderr):
+        summary = sync_drives(config, labels, args.action, jobs, max_concurrency)
+
+    print(json.dumps(summary, indent=2))
+    return 0 if summary['status'] == 'ok' else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,31 @@
 import os
 
+from encrypt import rsa
+
 class KeyManager:
     def __init__(self, folder_path):
         self.folder_path = folder_path
+        self._private_keys = {}
 
     def get_key(self, name):
         with open(self.folder_path + name + ".asc", "rb") as file:
             key = file.read()
         return key
-        
+
+    def get_private_key(self, name):
+        """Returns the parsed private key, which is loaded from disk only once"""
+        if name not in self._private_keys:
+            self._private_keys[name] = rsa.load_private_key(self.get_key(name))
+        return self._private_keys[name]
     
     def set_key(self, name:str, key:bytes) -> None:
+        self._private_keys.pop(name, None)
         os.makedirs(os.path.join(self.folder_path, os.path.dirname(name)), exist_ok=True)
         with open(self.folder_path + name + ".asc", "wb") as file:
             file.write(key)
 
     def delete_key(self, name):
+        self._private_keys.pop(name, None)
         os.remove(self.folder_path + name + ".asc")
 
     @property
@@ -1,11 +1,21 @@
-from ceased_cli import CLI
+import startup
 import os
+import sys
 
 
 if __name__ == "__main__":
+    startup.enable()
     os.makedirs("keys", exist_ok=True)
     os.makedirs("auth", exist_ok=True)
     with open("auth/PLACE CREDENTIALS HERE", "wb") as f:
         f.write(b"")
-    
+
+    # Subcommands run without prompts, e.g. from cron, and don't load the interactive CLI
+    if len(sys.argv) > 1:
+        from headless import main as run_headless
+        startup.mark('imports')
+        sys.exit(run_headless(sys.argv[1:]))
+
+    from ceased_cli import CLI
+    startup.mark('imports')
     CLI().run()
@@ -0,0 +1,209 @@
+import io
+import os
+import time
+import secrets
+import ujson as json
+
+from concurrent.futures import ThreadPoolExecutor
+
+from encrypt import hash_sha256
+
+
+# Paths are spread over 16 shards by the first hex digit of their salted hash
+SHARD_PREFIX_LENGTH = 1
+# Deltas are folded into the shards once this many have piled up
+COMPACT_AFTER = 32
+
+
+class Manifest:
+    """Remote `path -> entry` map stored as encrypted shards plus an append-only delta log.
+
+    Remote layout under `archiveinfo/<name>/`:
+        shard-<prefix>-<generation>  {"folded": [<delta name>, ...], "entries": {...}}
+        delta-<sequence>             {"set": {...}, "delete": [...]}
+
+    A shard lists the deltas folded into it by name. Deltas are named after the
+    clock of the client that wrote them, so a delta uploaded while another client
+    compacted can sort before deltas that were folded, and still has to apply.
+
+    Shards and deltas are never modified, only replaced under a new name, so the
+    decrypted copies cached in `.archiveinfo/manifest_cache/<name>/` stay valid
+    for as long as the remote object exists. A sync only downloads the objects it
+    has not seen before and uploads a single delta.
+    """
+
+    def __init__(self, drive, name:str) -> None:
+        self.drive = drive
+        self.name = name
+        self.folder = f'archiveinfo/{name}'
+        self.cache_folder = os.path.join(drive.local_path, '.archiveinfo', 'manifest_cache', name)
+        self.entries:dict = {}
+        self._shards:dict[str, str] = {}
+        self._deltas:list[str] = []
+        self._stale:list[str] = []
+
+    def _shard_prefix(self, path:str) -> str:
+        return hash_sha256(path.encode() + self.drive.salt).hex()[:SHARD_PREFIX_LENGTH]
+
+    @staticmethod
+    def _new_name(kind:str) -> str:
+        # Names sort in creation order
+        return f'{kind}-{time.time_ns():020d}-{secrets.token_hex(4)}'
+
+    def _read_object(self, object_name:str) -> dict:
+        cache_path = os.path.join(self.cache_folder, object_name + '.json')
+        try:
+            with open(cache_path, 'rb') as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+
+        stream = io.BytesIO()
+        self.drive.remote.download_to(f'{self.folder}/{object_name}', stream)
+        data = stream.getvalue()
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            f.write(data)
+        return json.loads(data)
+
+    def _write_object(self, object_name:str, content:dict):
+        data = json.dumps(content).encode()
+        self.drive.remote.require_folders([self.folder])
+        self.drive.remote.upload_encrypted(f'{self.folder}/{object_name}', io.BytesIO(data), len(data))
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        with open(os.path.join(self.cache_folder, object_name + '.json'), 'wb') as f:
+            f.write(data)
+
+    def _prune_cache(self, object_names:set[str]):
+        if not os.path.isdir(self.cache_folder):
+            return
+        for filename in os.listdir(self.cache_folder):
+            if filename.removesuffix('.json') not in object_names:
+                os.remove(os.path.join(self.cache_folder, filename))
+
+    def _migrate_legacy(self) -> dict:
+        """Moves the entries of a single-file `archiveinfo/<name>.json` manifest into shards"""
+        legacy_path = f'archiveinfo/{self.name}.json'
+        if not self.drive.remote.is_valid_path(legacy_path):
+            return {}
+
+        entries = json.loads(self.drive.remote.get_file_data(legacy_path, is_encrypted=True).decode())
+        self.entries = {}
+        self._write_shards(entries, folded=[])
+        self.entries = entries
+        self.drive.remote.delete_file(legacy_path)
+        return entries
+
+    def load(self) -> dict:
+        folder = self.drive.remote.get_dir(self.folder)
+        if not folder:
+            self._shards, self._deltas = {}, []
+            self.entries = self._migrate_legacy()
+            return dict(self.entries)
+
+        shards:dict[str, str] = {}
+        deltas = []
+        stale = []
+        for object_name in sorted(folder['children']):
+            if object_name.startswith('shard-'):
+                prefix = object_name.split('-')[1]
+                if prefix in shards:
+                    # Left behind by an interrupted compaction
+                    stale.append(shards[prefix])
+                shards[prefix] = object_name
+            elif object_name.startswith('delta-'):
+                deltas.append(object_name)
+
+        object_names = list(shards.values()) + deltas
+        with ThreadPoolExecutor() as executor:
+            contents = dict(zip(object_names, executor.map(self._read_object, object_names)))
+
+        entries = {}
+        folded:dict[str, set[str]] = {}
+        for prefix, object_name in shards.items():
+            shard = contents[object_name]
+            entries.update(shard['entries'])
+            folded[prefix] = set(shard['folded'])
+
+        for delta_name in deltas:
+            delta = contents[delta_name]
+            for path, entry in delta['set'].items():
+                if delta_name not in folded.get(self._shard_prefix(path), ()):
+                    entries[path] = entry
+            for path in delta['delete']:
+                if delta_name not in folded.get(self._shard_prefix(path), ()):
+                    entries.pop(path, None)
+
+        self._shards, self._deltas, self._stale = shards, deltas, stale
+        self._prune_cache(set(object_names))
+        self.entries = entries
+        return dict(entries)
+
+    def is_current(self) -> bool:
+        """Whether the remote objects are still the ones `entries` was built from"""
+        folder = self.drive.remote.get_dir(self.folder)
+        object_names = set(folder['children']) if folder else set()
+        return object_names == set(self._shards.values()) | set(self._deltas) | set(self._stale)
+
+    def update(self, entries:dict):
+        """Makes the remote manifest equal to `entries` by appending one delta with the differences"""
+        changed = {path: entry for path, entry in entries.items() if self.entries.get(path) != entry}
+        deleted = [path for path in self.entries if path not in entries]
+        if not changed and not deleted:
+            return
+
+        delta_name = self._new_name('delta')
+        self._write_object(delta_name, {"set": changed, "delete": deleted})
+        self._deltas.append(delta_name)
+        self.entries = dict(entries)
+
+        if len(self._deltas) > COMPACT_AFTER:
+            self.compact()
+
+    def _write_shards(self, entries:dict, folded:list[str], prefixes:set[str]=None):
+        by_prefix:dict[str, dict] = {}
+        for path, entry in entries.items():
+            by_prefix.setdefault(self._shard_prefix(path), {})[path] = entry
+
+        if prefixes is None:
+            prefixes = set(by_prefix)
+
+        shard_names = {prefix: self._new_name(f'shard-{prefix}') for prefix in prefixes}
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(
+                lambda prefix: self._write_object(
+                    shard_names[prefix],
+                    {"folded": folded, "entries": by_prefix.get(prefix, {})}
+                ),
+                prefixes
+            ))
+
+        replaced = [self._shards[prefix] for prefix in prefixes if prefix in self._shards]
+        self._shards.update(shard_names)
+        return replaced
+
+    def compact(self):
+        """Folds the delta log into new generations of the shards it touched"""
+        if not self._deltas:
+            return
+
+        touched = set()
+        for delta_name in self._deltas:
+            delta = self._read_object(delta_name)
+            touched.update(self._shard_prefix(path) for path in delta['set'])
+            touched.update(self._shard_prefix(path) for path in delta['delete'])
+
+        # Only the deltas read above are folded, ones uploaded meanwhile by other clients still apply
+        replaced = self._write_shards(self.entries, folded=list(self._deltas), prefixes=touched)
+
+        # Shards are in place before any delta disappears, so a crash never loses entries
+        obsolete = replaced + self._stale + self._deltas
+        errors = self.drive.remote.delete_files([f'{self.folder}/{object_name}' for object_name in obsolete])
+        for path, error in errors.items():
+            print(f"Error deleting manifest object `{path}`: {error}")
+
+        self._deltas = []
+        self._stale = []
+        self._prune_cache(set(self._shards.values()))
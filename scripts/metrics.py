@@ -0,0 +1,278 @@
+import os
+import time
+import tempfile
+import threading
+import ujson as json
+
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_HISTORY = 100
+
+
+class Metrics:
+    """Timings and counters of the push or pull that is currently running.
+
+    `phases` holds the seconds spent in each step. Steps that run on several
+    threads at once, like `encrypt` and `decrypt`, add up the time of every
+    thread, so they can exceed the wall time of the run.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._depth = 0
+        self.reset()
+
+    def reset(self, operation:str=None):
+        self.operation = operation
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.phases:dict[str, float] = {}
+        self.calls:dict[str, dict] = {}
+        self.counters:Counter = Counter()
+        self.backend:dict = {}
+
+    @contextmanager
+    def run(self, operation:str):
+        """Collects the metrics of one operation and yields `True` for the outermost one
+
+        Operations started inside another one, e.g. `pull_paths` called by
+        `pull_changes`, add to the running report instead of starting a new one.
+        """
+        outermost = self._depth == 0
+        if outermost:
+            self.reset(operation)
+        self._depth += 1
+        try:
+            yield outermost
+            if outermost:
+                self.status = 'ok'
+        except BaseException:
+            if outermost:
+                self.status = 'error'
+            raise
+        finally:
+            self._depth -= 1
+            if outermost:
+                self.finished = time.time()
+
+    @contextmanager
+    def phase(self, name:str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name:str, seconds:float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def record_call(self, method:str, seconds:float, failed:bool=False):
+        with self._lock:
+            stats = self.calls.get(method)
+            if stats is None:
+                stats = self.calls[method] = {'count': 0, 'errors': 0, 'seconds': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def count(self, name:str, amount:int=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_counts(self, prefix:str, counts:dict[str, int]):
+        for name, amount in counts.items():
+            self.count(f'{prefix}_{name}', amount)
+
+    def record_backend(self, kind:str, name:str=None):
+        """Counts a request attempt of type `name`, a retry or a throttle of the backend's scheduler"""
+        with self._lock:
+            if kind == 'requests':
+                requests = self.backend.setdefault('requests', {})
+                requests[name] = requests.get(name, 0) + 1
+            else:
+                self.backend[kind] = self.backend.get(kind, 0) + 1
+
+    def report(self) -> dict:
+        with self._lock:
+            calls = {}
+            for method, stats in self.calls.items():
+                cumulative = 0
+                histogram = {}
+                for bound, amount in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+                    cumulative += amount
+                    histogram[str(bound)] = cumulative
+                calls[method] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'seconds': round(stats['seconds'], 6),
+                    'histogram': histogram
+                }
+
+            return {
+                'operation': self.operation,
+                'status': self.status,
+                'started': self.started,
+                'seconds': round((self.finished or time.time()) - self.started, 6),
+                'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                'calls': calls,
+                'counters': dict(self.counters),
+                'backend': self.backend
+            }
+
+
+class _MeteredReader:
+    def __init__(self, stream, metrics:Metrics) -> None:
+        self._stream = stream
+        self._metrics = metrics
+
+    def __getattr__(self, name:str):
+        return getattr(self._stream, name)
+
+    def read(self, size:int=-1) -> bytes:
+        # Upload streams read, compress and encrypt the local file on demand
+        start = time.monotonic()
+        data = self._stream.read(size)
+        self._metrics.add_time('encrypt', time.monotonic() - start)
+        self._metrics.count('bytes_uploaded', len(data))
+        return data
+
+
+class _MeteredWriter:
+    def __init__(self, stream, metrics:Metrics) -> None:
+        self._stream = stream
+        self._metrics = metrics
+
+    def __getattr__(self, name:str):
+        return getattr(self._stream, name)
+
+    def write(self, data:bytes) -> int:
+        start = time.monotonic()
+        written = self._stream.write(data)
+        self._metrics.add_time('decrypt', time.monotonic() - start)
+        self._metrics.count('bytes_downloaded', len(data))
+        return written
+
+
+class MeteredStorage:
+    """Wraps a `StorageBackend` and records the latency of every call and the bytes moved
+
+    Backends with a `scheduler` also report the request attempts, retries and
+    throttles of the calls made through the wrapper, so a backend shared by
+    several drives doesn't count the other drives' calls.
+    """
+
+    def __init__(self, storage, metrics:Metrics) -> None:
+        self._storage = storage
+        self._metrics = metrics
+
+    def __getattr__(self, name:str):
+        attribute = getattr(self._storage, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self._call(name, attribute, *args, **kwargs)
+
+    def _call(self, method:str, function, *args, **kwargs):
+        scheduler = getattr(self._storage, 'scheduler', None)
+        start = time.monotonic()
+        try:
+            with scheduler.attribute_to(self._metrics.record_backend) if scheduler else nullcontext():
+                result = function(*args, **kwargs)
+        except Exception:
+            self._metrics.record_call(method, time.monotonic() - start, failed=True)
+            raise
+        self._metrics.record_call(method, time.monotonic() - start)
+        return result
+
+    def upload_stream(self, stream, *args, **kwargs) -> str:
+        return self._call('upload_stream', self._storage.upload_stream, _MeteredReader(stream, self._metrics), *args, **kwargs)
+
+    def update_stream(self, file_id:str, stream, *args, **kwargs) -> str:
+        return self._call('update_stream', self._storage.update_stream, file_id, _MeteredReader(stream, self._metrics), *args, **kwargs)
+
+    def download_to(self, file_id:str, stream, *args, **kwargs):
+        return self._call('download_to', self._storage.download_to, file_id, _MeteredWriter(stream, self._metrics), *args, **kwargs)
+
+    def upload_file(self, file_data:bytes, *args, **kwargs) -> str:
+        self._metrics.count('bytes_uploaded', len(file_data))
+        return self._call('upload_file', self._storage.upload_file, file_data, *args, **kwargs)
+
+    def download_file(self, file_id:str) -> bytes:
+        file_data = self._call('download_file', self._storage.download_file, file_id)
+        self._metrics.count('bytes_downloaded', len(file_data))
+        return file_data
+
+
+def _write_atomic(path:str, text:str):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # mkstemp creates the file as 0600, the node exporter usually runs as another user
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def write_report(report:dict, folder:str, history:int=DEFAULT_HISTORY) -> str:
+    """Writes `report` as JSON into `folder` and keeps the `history` most recent reports"""
+    os.makedirs(folder, exist_ok=True)
+    timestamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(report['started']))
+    path = os.path.join(folder, f"{timestamp}-{int(report['started'] * 1000) % 1000:03d}-{report['operation']}.json")
+    _write_atomic(path, json.dumps(report, indent=2))
+
+    # Names start with the time, so sorting them sorts the reports by age
+    reports = sorted(name for name in os.listdir(folder) if name.endswith('.json'))
+    for name in reports[:max(0, len(reports) - history)]:
+        os.remove(os.path.join(folder, name))
+    return path
+
+
+def _escape_label(value:str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(report:dict, path:str, labels:dict[str, str]):
+    """Writes `report` in the Prometheus text format, for the node exporter's textfile collector"""
+    def format_labels(extra:dict=None) -> str:
+        items = {**labels, 'operation': report['operation'], **(extra or {})}
+        return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in items.items()) + '}'
+
+    lines = [
+        '# TYPE ceased_last_run_timestamp_seconds gauge',
+        f"ceased_last_run_timestamp_seconds{format_labels()} {report['started']}",
+        '# TYPE ceased_last_run_success gauge',
+        f"ceased_last_run_success{format_labels()} {int(report['status'] == 'ok')}",
+        '# TYPE ceased_run_duration_seconds gauge',
+        f"ceased_run_duration_seconds{format_labels()} {report['seconds']}",
+        '# TYPE ceased_phase_duration_seconds gauge',
+    ]
+    for phase, seconds in report['phases'].items():
+        lines.append(f"ceased_phase_duration_seconds{format_labels({'phase': phase})} {seconds}")
+
+    lines.append('# TYPE ceased_run_total gauge')
+    for name, amount in report['counters'].items():
+        lines.append(f"ceased_run_total{format_labels({'counter': name})} {amount}")
+    for name, amount in report['backend'].get('requests', {}).items():
+        lines.append(f"ceased_run_total{format_labels({'counter': 'api_requests', 'method': name})} {amount}")
+    for name in ('retries', 'throttles'):
+        if name in report['backend']:
+            lines.append(f"ceased_run_total{format_labels({'counter': name})} {report['backend'][name]}")
+
+    lines.append('# TYPE ceased_storage_call_duration_seconds histogram')
+    for method, stats in report['calls'].items():
+        for bound, amount in stats['histogram'].items():
+            lines.append(f"ceased_storage_call_duration_seconds_bucket{format_labels({'method': method, 'le': bound})} {amount}")
+        lines.append(f"ceased_storage_call_duration_seconds_sum{format_labels({'method': method})} {stats['seconds']}")
+        lines.append(f"ceased_storage_call_duration_seconds_count{format_labels({'method': method})} {stats['count']}")
+
+    _write_atomic(path, '\n'.join(lines) + '\n')
@@ -0,0 +1,169 @@
+import time
+import random
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+
+DEFAULT_INITIAL_CONCURRENCY = 8
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 8
+
+BASE_DELAY = 0.5
+MAX_DELAY = 32.0
+# Concurrency is multiplied by this on throttling, at most once per cooldown
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 1.0
+# Concurrency stops growing while a call type is this much slower than its best
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+
+# Error kinds returned by `classify`
+THROTTLED = 'throttled'
+RETRY = 'retry'
+
+
+class AdaptiveScheduler:
+    """Limits the number of API calls in flight and retries the ones that fail.
+
+    The limit follows AIMD: every successful call raises it by `1 / limit`,
+    which adds about one slot per round of calls, and throttling halves it.
+    It stops growing while calls get slower than the fastest seen for their
+    type, so the limit settles just below the quota instead of bouncing off it.
+
+    `classify(error)` returns `THROTTLED`, `RETRY` or `None` for errors that
+    are final. Retries wait a jittered exponential backoff, or at least
+    `retry_after(error)` seconds when the server asked for that.
+    """
+
+    def __init__(
+        self,
+        classify,
+        retry_after=None,
+        initial_concurrency:int=DEFAULT_INITIAL_CONCURRENCY,
+        min_concurrency:int=DEFAULT_MIN_CONCURRENCY,
+        max_concurrency:int=DEFAULT_MAX_CONCURRENCY,
+        max_retries:int=DEFAULT_MAX_RETRIES
+    ) -> None:
+        self.classify = classify
+        self.retry_after = retry_after or (lambda error: None)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.in_flight = 0
+        # Attempts per call type, retries included
+        self.calls = Counter()
+        self.retries = 0
+        self.throttles = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._latency:dict[str, list[float]] = {}
+        self._last_decrease = 0.0
+
+    @property
+    def concurrency(self) -> int:
+        """Number of calls currently allowed in flight"""
+        return int(self.limit)
+
+    def _acquire(self, name:str):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self.calls[name] += 1
+        self._report('requests', name)
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _succeeded(self, name:str, latency:float):
+        with self._condition:
+            stats = self._latency.get(name)
+            if stats is None:
+                # [smoothed latency, lowest smoothed latency]
+                stats = self._latency[name] = [latency, latency]
+            else:
+                stats[0] += LATENCY_SMOOTHING * (latency - stats[0])
+                stats[1] = min(stats[1], stats[0])
+
+            if stats[0] <= LATENCY_TOLERANCE * stats[1] and self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def _report(self, kind:str, name:str=None):
+        sink = getattr(self._local, 'sink', None)
+        if sink is not None:
+            sink(kind, name)
+
+    @contextmanager
+    def attribute_to(self, sink):
+        """Also reports the calls this thread makes to `sink(kind, name)`
+
+        `kind` is `'requests'` for every attempt, with the call type as `name`,
+        `'retries'` or `'throttles'`. Lets a client that shares the scheduler
+        with others count only its own calls.
+        """
+        previous = getattr(self._local, 'sink', None)
+        self._local.sink = sink
+        try:
+            yield
+        finally:
+            self._local.sink = previous
+
+    def counters(self) -> dict:
+        """Returns a copy of the attempt, retry and throttle counters"""
+        with self._condition:
+            return {'requests': dict(self.calls), 'retries': self.retries, 'throttles': self.throttles}
+
+    def throttled(self):
+        """Backs off after the server signalled that it is overloaded"""
+        self._report('throttles')
+        with self._condition:
+            self.throttles += 1
+            now = time.monotonic()
+            # Calls that were in flight together tend to be throttled together
+            if now - self._last_decrease >= DECREASE_COOLDOWN:
+                self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+                self._last_decrease = now
+
+    def backoff(self, attempt:int, error:Exception=None) -> float:
+        """Seconds to wait before retry number `attempt + 1`"""
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        retry_after = self.retry_after(error) if error is not None else None
+        return max(delay, retry_after or 0)
+
+    def run(self, name:str, function, *args, **kwargs):
+        """Calls `function` once a slot is free, retrying it on retryable errors
+
+        Raises:
+            Exception: the last error, once it is final or the retries are used up
+        """
+        attempt = 0
+        while True:
+            self._acquire(name)
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                self._release()
+                kind = self.classify(error)
+                if kind is None or attempt >= self.max_retries:
+                    raise
+                if kind == THROTTLED:
+                    self.throttled()
+                with self._condition:
+                    self.retries += 1
+                self._report('retries')
+                time.sleep(self.backoff(attempt, error))
+                attempt += 1
+                continue
+
+            self._release()
+            self._succeeded(name, time.monotonic() - start)
+            return result
@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import atexit
+import json
+
+
+# Set this environment variable to print the startup timings to stderr when the program exits
+TIMING_VARIABLE = 'CEASED_STARTUP_TIMING'
+
+_started = time.perf_counter()
+_steps:dict[str, float] = {}
+
+
+def mark(step:str):
+    """Records that `step` finished, in seconds since this module was first imported
+
+    Only the first time a step finishes is kept, so a step reached by several
+    drives or threads shows when the first of them got there.
+    """
+    _steps.setdefault(step, round(time.perf_counter() - _started, 6))
+
+
+def report() -> dict:
+    return {
+        'steps': dict(_steps),
+        'seconds': round(time.perf_counter() - _started, 6)
+    }
+
+
+def enable():
+    """Prints the timings of every step to stderr at exit, if `CEASED_STARTUP_TIMING` is set"""
+    if os.environ.get(TIMING_VARIABLE):
+        atexit.register(lambda: print(json.dumps({'startup': report()}, indent=2), file=sys.stderr))
@@ -0,0 +1,88 @@
+import io
+
+
+class ChangesExpiredError(Exception):
+    def __init__(self, page_token:str) -> None:
+        self.message = f"Change cursor {page_token} is no longer valid"
+        super().__init__(self.message)
+
+
+class UploadSessionExpiredError(Exception):
+    def __init__(self, name:str) -> None:
+        self.message = f"The upload session of {name} has expired"
+        super().__init__(self.message)
+
+
+class StorageBackend:
+    """Where `Drive.Remote` keeps the encrypted archive.
+
+    Files and folders are addressed by opaque ids handed out by the backend.
+    Listings return dicts with the `id`, `name` and `is_folder` of each item.
+    The batch methods default to one call per item and change tracking is
+    optional: a backend without a change feed returns `None` from
+    `get_start_page_token`, and the remote tree is listed again on every sync.
+
+    Backends with `resumable_uploads` accept an `UploadSession` in
+    `upload_stream`, resume it from the last confirmed offset and raise
+    `UploadSessionExpiredError` once the server has discarded it.
+    """
+
+    resumable_uploads = False
+
+    def list_folder(self, folder_id:str) -> list[dict]:
+        raise NotImplementedError
+
+    def create_folder(self, name:str, parent_folder_id:str=None) -> str:
+        raise NotImplementedError
+
+    def upload_stream(self, stream, name:str, parent_folder_id:str, mimetype:str='application/octet-stream', chunksize:int=None, session=None) -> str:
+        raise NotImplementedError
+
+    def update_stream(self, file_id:str, stream, mimetype:str='application/octet-stream', chunksize:int=None, session=None) -> str:
+        """Replaces the content of `file_id` in place"""
+        raise NotImplementedError
+
+    def download_to(self, file_id:str, stream, chunksize:int=None):
+        raise NotImplementedError
+
+    def delete_file(self, file_id:str):
+        raise NotImplementedError
+
+    def upload_file(self, file_data:bytes, name:str, parent_folder_id:str, mimetype:str='application/octet-stream') -> str:
+        return self.upload_stream(io.BytesIO(file_data), name, parent_folder_id, mimetype)
+
+    def download_file(self, file_id:str) -> bytes:
+        file = io.BytesIO()
+        self.download_to(file_id, file)
+        return file.getvalue()
+
+    def create_folders(self, folders:list[tuple[str, str]]) -> list[str|Exception]:
+        """Creates `(name, parent_folder_id)` folders and returns their ids, or the error each failed with"""
+        results = []
+        for name, parent_folder_id in folders:
+            try:
+                results.append(self.create_folder(name, parent_folder_id))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def delete_files(self, file_ids:list[str]) -> list[Exception|None]:
+        results = []
+        for file_id in file_ids:
+            try:
+                self.delete_file(file_id)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def get_start_page_token(self) -> str|None:
+        return None
+
+    def list_changes(self, page_token:str) -> tuple[list[dict], str]:
+        """Lists every change made since `page_token`
+
+        Each change has a `fileId`, a `removed` flag and the changed `file` with
+        its `id`, `name`, `is_folder`, `parents` and `trashed` state.
+        """
+        raise ChangesExpiredError(page_token)
@@ -1,16 +1,158 @@
+import io
 import os
 import time
 import ujson as json
 import secrets
+import tempfile
+import threading
 
 from base64 import urlsafe_b64encode
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 
 from key_manager import KeyManager
-from encrypt import rsa, aes, hash_md5, hash_sha256
-from google_drive import GoogleDrive
+from file_index import FileIndex
+from hashing import HashingEngine, ALGORITHMS as HASH_ALGORITHMS, DEFAULT_ALGORITHM as DEFAULT_HASH_ALGORITHM, DEFAULT_WORKERS as DEFAULT_HASH_WORKERS, algorithm_of
+from upload_sessions import UploadSessions
+from manifest import Manifest
+from metrics import Metrics, MeteredStorage, DEFAULT_HISTORY as DEFAULT_METRICS_HISTORY, write_report, write_prometheus
+from chat_store import ChatStore
+from chunker import iter_chunks, MAX_CHUNK_SIZE
+from compression import CODECS, SAMPLE_SIZE, is_compressible, compress_stream
+from encrypt import rsa, aes, hash_sha256, stream_length, EncryptingReader, DecryptingWriter
+from storage import StorageBackend, ChangesExpiredError, UploadSessionExpiredError
+from directory_backend import DirectoryBackend, DEFAULT_WORKERS as DEFAULT_DIRECTORY_WORKERS
+from google_drive import GoogleDrive, DEFAULT_CHUNK_SIZE, CHUNK_SIZE_MULTIPLE
 
 KEY_DELIMITER = 'RljUoVUFjfAFkfSEg61sWpcdnipjJe5vFwiVNTF75Nc'
+DEFAULT_PULL_WORKERS = 8
+DEFAULT_PUSH_WORKERS = 16
+DEFAULT_PUSH_MEMORY_BUDGET = 512 * 1024 * 1024
+# How often lighter files may start ahead of one that doesn't fit the budget yet,
+# and how far down the queue to look for them
+MAX_BUDGET_BYPASSES = 64
+BUDGET_SCAN_WINDOW = 256
+DEFAULT_CHUNKED_STORAGE_MIN_SIZE = 16 * 1024 * 1024
+# Files smaller than `pack_threshold` are stored together in packs of about `pack_size` bytes
+DEFAULT_PACK_THRESHOLD = 64 * 1024
+DEFAULT_PACK_SIZE = 8 * 1024 * 1024
+# A pack is rewritten once more than this share of it belongs to files that changed or are gone
+DEFAULT_REPACK_DEAD_RATIO = 0.5
+DEFAULT_COMPRESSION = 'zlib'
+DEFAULT_COMPRESSION_LEVEL = 6
+# Compressed data larger than this spills from memory into a temporary file
+COMPRESSION_SPOOL_SIZE = 8 * 1024 * 1024
+# Top-level folders that are only listed once a path inside them is looked up
+LAZY_FOLDERS = ('files',)
+# Local key the saved copy of the remote folder structure is encrypted with
+HIERARCHY_CACHE_KEY = 'user/cache'
+
+
+def run_bounded(function, items, max_workers:int):
+    """Runs `function` on every item in a thread pool and yields `(item, error)` as each one finishes.
+
+    At most twice `max_workers` items are queued at a time, so the work list can
+    be arbitrarily long without creating a future for every item up front.
+    """
+    slots = threading.BoundedSemaphore(max_workers * 2)
+    finished = []
+    lock = threading.Lock()
+
+    def done(item, future):
+        with lock:
+            finished.append((item, future.exception()))
+        slots.release()
+
+    def drain():
+        with lock:
+            results = finished[:]
+            finished.clear()
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            while not slots.acquire(timeout=0.1):
+                yield from drain()
+            future = executor.submit(function, item)
+            future.add_done_callback(lambda future, item=item: done(item, future))
+            yield from drain()
+
+    yield from drain()
+
+
+def run_budgeted(function, items, weigh, budget:int, max_workers:int):
+    """Runs `function` on every item in a thread pool and yields `(item, result, error)` as each one finishes.
+
+    An item only starts while the weights of the items running, including its
+    own, add up to at most `budget`. Items that don't fit yet let lighter ones
+    further down the queue go first, but only `MAX_BUDGET_BYPASSES` times. Then
+    nothing else starts until the waiting item fits. An item heavier than the
+    whole budget runs on its own.
+    """
+    pending = deque((item, min(weigh(item), budget)) for item in items)
+    condition = threading.Condition()
+    finished = []
+    in_flight = {'weight': 0, 'items': 0}
+
+    def run(item, weight:int):
+        try:
+            result, error = function(item), None
+        except Exception as e:
+            result, error = None, e
+        with condition:
+            in_flight['weight'] -= weight
+            in_flight['items'] -= 1
+            finished.append((item, result, error))
+            condition.notify()
+
+    def fits(weight:int) -> bool:
+        return in_flight['weight'] + weight <= budget
+
+    bypasses = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Items can finish while earlier results are being yielded, so the loop also drains those
+        while pending or in_flight['items'] or finished:
+            with condition:
+                while in_flight['items'] < max_workers and pending:
+                    index = None
+                    if fits(pending[0][1]):
+                        index, bypasses = 0, 0
+                    elif bypasses < MAX_BUDGET_BYPASSES:
+                        index = next((
+                            i for i in range(1, min(len(pending), BUDGET_SCAN_WINDOW))
+                            if fits(pending[i][1])
+                        ), None)
+                        bypasses += index is not None
+                    if index is None:
+                        break
+
+                    item, weight = pending[index]
+                    del pending[index]
+                    in_flight['weight'] += weight
+                    in_flight['items'] += 1
+                    executor.submit(run, item, weight)
+
+                if not finished:
+                    condition.wait()
+                results = finished[:]
+                finished.clear()
+            yield from results
+
+
+def create_storage(drive_settings:dict, google_drive:GoogleDrive=None) -> tuple[StorageBackend, str]:
+    """Returns the storage backend of a drive in `folders_to_sync` and the id of its root folder"""
+    backend = drive_settings.get('backend', 'google_drive')
+    if backend == 'directory':
+        storage = DirectoryBackend(
+            drive_settings['remote_path'],
+            workers=drive_settings.get('workers', DEFAULT_DIRECTORY_WORKERS),
+            fsync=drive_settings.get('fsync', True)
+        )
+        return storage, storage.root_folder_id
+    elif backend == 'google_drive':
+        return google_drive or GoogleDrive(), drive_settings['remote_folder_id']
+    raise ValueError(f"Unknown storage backend {backend}")
 
 
 class Drive:
@@ -19,23 +161,49 @@ class Drive:
         config:dict,
         local_path:str,
         remote_folder_id:str,
-        google_drive:GoogleDrive=None,
+        storage:StorageBackend=None,
         key_manager:KeyManager=None
     ) -> None:
         self.config = config
         self.local_path = local_path
-        self.gd = google_drive or GoogleDrive()
+        self.storage = storage or GoogleDrive()
         self.km = key_manager or KeyManager(self.config['key_folder'])
+        self.metrics = Metrics()
         self.remote = self.Remote(self, remote_folder_id)
         self.local = self.Local(self, self.local_path)
 
         self.username = self.config['username']
+        self.transfer_chunk_size = self.config.get('transfer_chunk_size', DEFAULT_CHUNK_SIZE)
+        if self.transfer_chunk_size <= 0 or self.transfer_chunk_size % CHUNK_SIZE_MULTIPLE:
+            raise ValueError(f"transfer_chunk_size must be a multiple of {CHUNK_SIZE_MULTIPLE} bytes")
+        self.pull_workers = self.config.get('pull_workers', DEFAULT_PULL_WORKERS)
+        self.push_workers = self.config.get('push_workers', DEFAULT_PUSH_WORKERS)
+        self.push_memory_budget = self.config.get('push_memory_budget', DEFAULT_PUSH_MEMORY_BUDGET)
+        self.hash_algorithm = self.config.get('hash_algorithm', DEFAULT_HASH_ALGORITHM)
+        if self.hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {self.hash_algorithm}")
+        self.chunked_storage = self.config.get('chunked_storage', False)
+        self.chunked_storage_min_size = self.config.get('chunked_storage_min_size', DEFAULT_CHUNKED_STORAGE_MIN_SIZE)
+        self.pack_small_files = self.config.get('pack_small_files', False)
+        self.pack_threshold = self.config.get('pack_threshold', DEFAULT_PACK_THRESHOLD)
+        self.pack_size = self.config.get('pack_size', DEFAULT_PACK_SIZE)
+        self.repack_dead_ratio = self.config.get('repack_dead_ratio', DEFAULT_REPACK_DEAD_RATIO)
+        self.compression = self.config.get('compression', DEFAULT_COMPRESSION)
+        self.compression_level = self.config.get('compression_level', DEFAULT_COMPRESSION_LEVEL)
+        if self.compression and self.compression not in CODECS:
+            raise ValueError(f"Unknown compression codec {self.compression}")
+        self.metrics_enabled = self.config.get('metrics', True)
+        self.metrics_history = self.config.get('metrics_history', DEFAULT_METRICS_HISTORY)
+        self.metrics_textfile_dir = self.config.get('metrics_textfile_dir')
+        self.cache_remote_hierarchy = self.config.get('cache_remote_hierarchy', True)
+        self._chunk_uploads:dict[str, threading.Event] = {}
+        self._chunk_lock = threading.Lock()
+        # Files the last push or push_paths failed to push or delete
+        self.push_failures:set[str] = set()
 
         self.remote.map_structure()
 
-        self.remote.create_folder('archiveinfo')
-        self.remote.create_folder('archiveinfo/users')
-        self.remote.create_folder('files')
+        self.remote.require_folders(['archiveinfo', 'archiveinfo/users', f'archiveinfo/users/{self.username}', 'files'])
 
         if not self.remote.is_valid_path('archiveinfo/id.txt'):
             self.id = secrets.token_urlsafe(24)
@@ -45,7 +213,6 @@ class Drive:
             self.id = self.remote.get_file_data('archiveinfo/id.txt').decode()
 
 
-        self.remote.create_folder(f'archiveinfo/users/{self.username}')
         self.remote.create_file(
             f'archiveinfo/users/{self.username}/public.asc',
             self.km.get_key('user/public')
@@ -53,7 +220,13 @@ class Drive:
 
 
         self.local.create_folder('.archiveinfo')
-        
+        self.file_index = FileIndex(self.local_path, os.path.join(self.local_path, '.archiveinfo', 'file_index.json'))
+        self.upload_sessions = UploadSessions(os.path.join(self.local_path, '.archiveinfo', 'upload_sessions.json'))
+        self.file_hashes = Manifest(self, 'file_hashes')
+        self.chunk_index = Manifest(self, 'chunk_index')
+        # name -> [pack name, offset, length, pack size]
+        self.pack_index = Manifest(self, 'pack_index')
+
 
         self.chat = self.Chat(self)
 
@@ -64,44 +237,201 @@ class Drive:
             self.aes_key = None
             self.salt = None
 
+        # Keyed with the salt, so every user of the archive computes the same digests
+        self.hasher = HashingEngine(self.hash_algorithm, self.salt, self.config.get('hash_workers', DEFAULT_HASH_WORKERS))
+
     class Remote():
         def __init__(self, parent:'Drive', root_folder_id:str=None) -> None:
             self.parent = parent
-            self.gd = parent.gd
+            # Every call made through `Remote` is timed in the drive's metrics
+            self.storage = MeteredStorage(parent.storage, parent.metrics)
             self.root_folder_id = root_folder_id
 
-        def map_structure(self):
-            def _map_structure(parent_id):
-                local_structure = {}
-                files = self.gd.search_file(f'parents in "{parent_id}" and trashed=false', ['id', 'name', 'mimeType'])
-                
-                folder_futures = []  
-
-                with ThreadPoolExecutor() as executor:
-                    for i, file in enumerate(files):
-                        name = file['name']
-                        file_id = file['id']
-                        mime_type = file['mimeType']
-
-                        local_structure[name] = {
-                            "id": file_id,
-                        }
+            self.remote_hierarchy = None
+            self.page_token = None
+            self.snapshot_path = os.path.join(parent.local_path, '.archiveinfo', 'remote_hierarchy')
+            self._snapshot_dirty = False
+            self._listing_lock = threading.Lock()
 
+        def _list_tree(self, parent_id, lazy_folders=()):
+            """Lists the folder `parent_id` recursively, except for the subfolders named in `lazy_folders`
 
-                        if mime_type == 'application/vnd.google-apps.folder':
-                            future = executor.submit(_map_structure, file_id)
-                            folder_futures.append((name, future))
+            Those are left unlisted, with their `children` set to `None`, until `get_dir`
+            needs to look inside them.
+            """
+            local_structure = {}
+            files = self.storage.list_folder(parent_id)
+            
+            folder_futures = []  
+
+            with ThreadPoolExecutor() as executor:
+                for i, file in enumerate(files):
+                    name = file['name']
+                    file_id = file['id']
+
+                    local_structure[name] = {
+                        "id": file_id,
+                    }
+
+
+                    if file['is_folder'] and name in lazy_folders:
+                        local_structure[name].update(children=None, unlisted=True)
+                    elif file['is_folder']:
+                        future = executor.submit(self._list_tree, file_id)
+                        folder_futures.append((name, future))
+
+                for name, future in folder_futures:
+                    local_structure[name]['children'] = future.result()
+
+
+            return local_structure
+
+        def map_structure(self, full:bool=False):
+            """Brings `remote_hierarchy` up to date
+
+            The whole tree is only listed the first time, or when `full` is set or the
+            change cursor has expired. Otherwise only the changes made since the last
+            call are fetched and applied. The first call of a session starts from the
+            snapshot the previous session saved, if there is one. Folders in
+            `LAZY_FOLDERS` are listed when a path inside them is first looked up.
+            """
+            with self.parent.metrics.phase('map_structure'):
+                if self.remote_hierarchy is None and not full:
+                    self._load_snapshot()
+
+                if not full and self.page_token is not None:
+                    try:
+                        changes, self.page_token = self.storage.list_changes(self.page_token)
+                        self._apply_changes(changes)
+                        if changes:
+                            self._snapshot_dirty = True
+                            self.save_snapshot()
+                        return
+                    except ChangesExpiredError:
+                        pass
+
+                # Taking the cursor before listing means nothing changed during the walk is missed
+                page_token = self.storage.get_start_page_token()
+                self.remote_hierarchy = self._list_tree(self.root_folder_id, LAZY_FOLDERS)
+                self.page_token = page_token
+                self._snapshot_dirty = True
+                self.save_snapshot()
+
+        def _snapshot_key(self) -> bytes:
+            try:
+                return self.parent.km.get_key(HIERARCHY_CACHE_KEY)
+            except FileNotFoundError:
+                key = aes.generate_key()
+                self.parent.km.set_key(HIERARCHY_CACHE_KEY, key)
+                return key
+
+        def _load_snapshot(self):
+            """Restores `remote_hierarchy` and its change cursor from the snapshot of an earlier session"""
+            if not self.parent.cache_remote_hierarchy or not os.path.isfile(self.snapshot_path):
+                return
+            try:
+                with open(self.snapshot_path, 'rb') as f:
+                    snapshot = json.loads(aes.decrypt(f.read(), self._snapshot_key()))
+            except Exception as e:
+                print(f"Ignoring the saved remote folder structure, it can't be read: {type(e).__name__}")
+                return
 
-                    fs = json.dumps(local_structure, indent=2)
-                    for name, future in folder_futures:
-                        local_structure[name]['children'] = future.result()
+            # The local folder may have been pointed at another archive since
+            if snapshot.get('root_folder_id') == self.root_folder_id and snapshot.get('page_token') is not None:
+                self.remote_hierarchy = snapshot['hierarchy']
+                self.page_token = snapshot['page_token']
 
+        def save_snapshot(self):
+            """Saves `remote_hierarchy` and its change cursor encrypted, if they changed since the last save
 
-                return local_structure
-            
-            self.remote_hierarchy = _map_structure(self.root_folder_id)
+            Changes made after the cursor was taken are reported again by the next
+            change listing, and applying them a second time leaves the tree as it is.
+            """
+            if not self._snapshot_dirty or not self.parent.cache_remote_hierarchy or self.page_token is None:
+                return
+            snapshot = {
+                "root_folder_id": self.root_folder_id,
+                "page_token": self.page_token,
+                "hierarchy": self.remote_hierarchy
+            }
+            try:
+                data = aes.encrypt(json.dumps(snapshot).encode(), self._snapshot_key())
+                with self.parent.local.open_atomic(os.path.relpath(self.snapshot_path, self.parent.local_path)) as f:
+                    f.write(data)
+                self._snapshot_dirty = False
+            except OSError as e:
+                print(f"Error saving the remote folder structure: {e}")
+
+        def _list_lazy_folder(self, node:dict):
+            with self._listing_lock:
+                # Another thread may have listed it while this one waited
+                if node.get('unlisted'):
+                    with self.parent.metrics.phase('map_structure'):
+                        node['children'] = self._list_tree(node['id'])
+                    del node['unlisted']
+                    self._snapshot_dirty = True
+
+        def _apply_changes(self, changes:list[dict]):
+            folders = {self.root_folder_id: self.remote_hierarchy}
+            locations = {}
+
+            def index(level:dict):
+                for name, node in level.items():
+                    locations[node['id']] = (level, name)
+                    if node.get('children') is not None:
+                        folders[node['id']] = node['children']
+                        index(node['children'])
+            index(self.remote_hierarchy)
+
+            pending = []
+            for change in changes:
+                file_id = change['fileId']
+                node = None
+                if file_id in locations:
+                    level, name = locations.pop(file_id)
+                    if level.get(name, {}).get('id') == file_id:
+                        node = level.pop(name)
+
+                file = change.get('file')
+                if change.get('removed') or not file or file.get('trashed'):
+                    continue
+                pending.append((file, node))
+
+            # Children can be reported before the folder they were created in
+            while pending:
+                unresolved = []
+                for file, node in pending:
+                    parent_id = next((parent for parent in file.get('parents', []) if parent in folders), None)
+                    if parent_id is None:
+                        unresolved.append((file, node))
+                        continue
+
+                    if node is None:
+                        node = {"id": file['id']}
+                        if file['is_folder'] and parent_id == self.root_folder_id and file['name'] in LAZY_FOLDERS:
+                            node.update(children=None, unlisted=True)
+                        elif file['is_folder']:
+                            # A folder moved in from elsewhere brings its existing contents along
+                            node['children'] = self._list_tree(file['id'])
+                            index(node['children'])
+
+                    level = folders[parent_id]
+                    level[file['name']] = node
+                    locations[file['id']] = (level, file['name'])
+                    if node.get('children') is not None:
+                        folders[file['id']] = node['children']
+
+                # Whatever is left lives outside of this archive
+                if len(unresolved) == len(pending):
+                    break
+                pending = unresolved
 
         def get_dir(self, path:str|list[str]) -> dict:
+            """Returns the node at `path`, listing the lazy folders on the way
+
+            The `children` of a lazy folder that is returned without being looked
+            into are `None` until then.
+            """
             if isinstance(path, str):
                 path = path.split('/')
             path_len = len(path)
@@ -112,6 +442,8 @@ class Drive:
                     return None
                 if i >= path_len-1:
                     return level
+                if level.get('unlisted'):
+                    self._list_lazy_folder(level)
                 level = level.get('children')
             
         def is_valid_path(self, path:str|list[str]):
@@ -148,6 +480,7 @@ class Drive:
                 "id": created_item_id,
                 "children": {} if is_folder else None
             }
+            self._snapshot_dirty = True
 
         def create_folder(self, remote_path: str):
             if self.is_valid_path(remote_path):
@@ -158,10 +491,47 @@ class Drive:
             if not new_folder_name or not parent_folder_id:
                 return
 
-            created_folder_id = self.gd.create_folder(new_folder_name, parent_folder_id)
+            created_folder_id = self.storage.create_folder(new_folder_name, parent_folder_id)
             self._update_hierarchy(remote_path_parts, new_folder_name, created_folder_id, is_folder=True)
             # self._update_last_changed()
 
+        def create_folders(self, remote_paths: list[str]) -> dict[str, Exception]:
+            """Creates the missing folders with one batch request per nesting level
+
+            Returns:
+                dict[str, Exception]: the paths that could not be created and why
+            """
+            remote_paths = list(dict.fromkeys(remote_paths))
+            errors = {}
+            for depth in sorted({path.count('/') for path in remote_paths}):
+                pending = []
+                for path in remote_paths:
+                    if path.count('/') != depth or self.is_valid_path(path):
+                        continue
+                    new_folder_name, parent_folder_id, remote_path_parts = self._get_parent_folder_info(path)
+                    if not new_folder_name or not parent_folder_id:
+                        errors[path] = ValueError(f"Invalid path {path}")
+                        continue
+                    pending.append((path, new_folder_name, parent_folder_id, remote_path_parts))
+
+                if not pending:
+                    continue
+
+                results = self.storage.create_folders([(name, parent_id) for _, name, parent_id, _ in pending])
+                for (path, new_folder_name, _, remote_path_parts), result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        errors[path] = result
+                    else:
+                        self._update_hierarchy(remote_path_parts, new_folder_name, result, is_folder=True)
+            return errors
+
+        def require_folders(self, remote_paths: list[str]):
+            """Creates the missing folders like `create_folders`, but raises if any of them could not be created"""
+            errors = self.create_folders(remote_paths)
+            if errors:
+                path, error = next(iter(errors.items()))
+                raise IOError(f"Could not create folder {path}: {error}") from error
+
         def create_file(self, remote_path: str, file_data: bytes, mimetype: str = 'application/octet-stream', should_encrypt:bool=False):
             if self.is_valid_path(remote_path):
                 # print(f'Error creating file ({remote_path}): File allready exists')
@@ -175,7 +545,7 @@ class Drive:
             if should_encrypt:
                 file_data = aes.encrypt(file_data, self.parent.aes_key)
 
-            created_file_id = self.gd.upload_file(file_data, new_file_name, parent_folder_id, mimetype)
+            created_file_id = self.storage.upload_file(file_data, new_file_name, parent_folder_id, mimetype)
             self._update_hierarchy(remote_path_parts, new_file_name, created_file_id, is_folder=False)
         
         def get_file_data(self, remote_path: str, is_encrypted:bool=False):
@@ -183,19 +553,151 @@ class Drive:
                 raise ValueError(f"File {remote_path} does not exist")
             
             file_id = self.get_path_id(remote_path)
-            file_data = self.gd.download_file(file_id)
+            file_data = self.storage.download_file(file_id)
             if is_encrypted:
                 file_data = aes.decrypt(file_data, self.parent.aes_key)
             return file_data
 
+        def upload_source(self, local_file_path: str) -> dict:
+            """Identifies the encrypted bytes an upload of `local_file_path` would produce"""
+            stat = os.stat(local_file_path)
+            return {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "inode": stat.st_ino,
+                "compression": [self.parent.compression, self.parent.compression_level],
+            }
+
+        def upload_encrypted(self, remote_path: str, stream, size: int, source: dict=None, overwrite: bool=False):
+            """Encrypts and uploads a seekable stream of `size` bytes without loading it into memory
+
+            Compressible data is compressed first when compression is enabled. The
+            codec is recorded in the stream header, so downloads decompress it again.
+
+            When `source` identifies the stream and the backend supports it, the upload
+            is resumable: an upload of the same source interrupted by a crash continues
+            from the last confirmed byte on the next call.
+
+            An existing file is left alone, unless `overwrite` is set. Its content is then
+            replaced in place, which keeps the file id and its revision history.
+            """
+            existing_file_id = None
+            if self.is_valid_path(remote_path):
+                if not overwrite:
+                    self.parent.upload_sessions.finish(remote_path)
+                    return
+                existing_file_id = self.get_path_id(remote_path)
+            else:
+                new_file_name, parent_folder_id, remote_path_parts = self._get_parent_folder_info(remote_path)
+
+                if not new_file_name or not parent_folder_id:
+                    return
+
+            with ExitStack() as stack:
+                flags = 0
+                codec = self.parent.compression
+                if codec:
+                    stream.seek(0)
+                    sample = stream.read(SAMPLE_SIZE)
+                    stream.seek(0)
+
+                if codec and is_compressible(sample):
+                    compressed = stack.enter_context(tempfile.SpooledTemporaryFile(
+                        max_size=COMPRESSION_SPOOL_SIZE, dir=self.parent.local.temp_folder
+                    ))
+                    compressed_size = compress_stream(stream, compressed, codec, self.parent.compression_level)
+                    if compressed_size < size:
+                        stream, size, flags = compressed, compressed_size, CODECS[codec]
+
+                # Uploads that fit in one request have nothing to resume
+                session = None
+                if (
+                    source is not None and self.storage.resumable_uploads
+                    and stream_length(size) > self.parent.transfer_chunk_size
+                ):
+                    session = self.parent.upload_sessions.open(remote_path, source)
+
+                def upload():
+                    # A resumed session must produce the same bytes, so it reuses the nonce prefix
+                    reader = EncryptingReader(
+                        stream, self.parent.aes_key, size,
+                        nonce_prefix=session.nonce_prefix if session else None, flags=flags
+                    )
+                    if session is not None and not session.attach(reader):
+                        # The file changed under the same size and mtime, the bytes sent so far are useless
+                        session.restart()
+                        reader = EncryptingReader(stream, self.parent.aes_key, size, nonce_prefix=session.nonce_prefix, flags=flags)
+                        session.attach(reader)
+                    if existing_file_id is not None:
+                        return self.storage.update_stream(
+                            existing_file_id, reader,
+                            chunksize=self.parent.transfer_chunk_size, session=session
+                        )
+                    return self.storage.upload_stream(
+                        reader, new_file_name, parent_folder_id,
+                        chunksize=self.parent.transfer_chunk_size, session=session
+                    )
+
+                try:
+                    created_file_id = upload()
+                except UploadSessionExpiredError:
+                    session.restart()
+                    created_file_id = upload()
+
+            if source is not None:
+                self.parent.upload_sessions.finish(remote_path)
+            if existing_file_id is None:
+                self._update_hierarchy(remote_path_parts, new_file_name, created_file_id, is_folder=False)
+
+        def upload_local_file(self, remote_path: str, local_file_path: str, overwrite: bool=False):
+            with open(local_file_path, 'rb') as f:
+                source = self.upload_source(local_file_path)
+                self.upload_encrypted(remote_path, f, source['size'], source, overwrite)
+
+        def download_to(self, remote_path: str, stream):
+            """Downloads an encrypted file and writes the decrypted data to `stream` chunk by chunk"""
+            if not self.is_valid_path(remote_path):
+                raise ValueError(f"File {remote_path} does not exist")
+
+            writer = DecryptingWriter(stream, self.parent.aes_key)
+            self.storage.download_to(self.get_path_id(remote_path), writer, chunksize=self.parent.transfer_chunk_size)
+            writer.finish()
+
+        def _remove_from_hierarchy(self, remote_path: str):
+            remote_path_parts = remote_path.split('/')
+            if len(remote_path_parts) > 1:
+                level = self.get_dir(remote_path_parts[:-1])['children']
+            else:
+                level = self.remote_hierarchy
+            level.pop(remote_path_parts[-1], None)
+            self._snapshot_dirty = True
+
         def delete_file(self, remote_path: str):
             if not self.is_valid_path(remote_path):
                 return
             
             file_id = self.get_path_id(remote_path)
-            self.gd.delete_file(file_id)
-            self.get_dir(remote_path.split('/')[:-1])['children'].pop(remote_path.split('/')[-1])
-            
+            self.storage.delete_file(file_id)
+            self._remove_from_hierarchy(remote_path)
+
+        def delete_files(self, remote_paths: list[str]) -> dict[str, Exception]:
+            """Deletes every existing path using batch requests
+
+            Returns:
+                dict[str, Exception]: the paths that could not be deleted and why
+            """
+            existing_paths = [path for path in dict.fromkeys(remote_paths) if self.is_valid_path(path)]
+            if not existing_paths:
+                return {}
+            results = self.storage.delete_files([self.get_path_id(path) for path in existing_paths])
+
+            errors = {}
+            for path, error in zip(existing_paths, results):
+                if error:
+                    errors[path] = error
+                else:
+                    self._remove_from_hierarchy(path)
+            return errors
 
     class Local():
         def __init__(self, parent:'Drive', local_path:str) -> None:
@@ -230,6 +732,28 @@ class Drive:
             with open(os.path.join(self.local_path, path), 'wb') as f:
                 f.write(file_data)
         
+        @property
+        def temp_folder(self) -> str:
+            temp_folder = os.path.join(self.local_path, '.archiveinfo', 'tmp')
+            os.makedirs(temp_folder, exist_ok=True)
+            return temp_folder
+
+        @contextmanager
+        def open_atomic(self, path:str):
+            """Opens `path` for writing through a temporary file that replaces it once fully written"""
+            target_path = os.path.join(self.local_path, path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+            fd, temp_path = tempfile.mkstemp(dir=self.temp_folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    yield f
+                os.replace(temp_path, target_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
         def get_file_data(self, path:str):
             with open(os.path.join(self.local_path, path), 'rb') as f:
                 return f.read()
@@ -241,18 +765,37 @@ class Drive:
         def __init__(self, parent:'Drive') -> None:
             self.p = parent
 
-            if not self.p.local.is_path_valid('.archiveinfo/chat.json'):
-                self.p.local.write_file('.archiveinfo/chat.json', json.dumps({}).encode())
+            self.store = ChatStore(os.path.join(self.p.local_path, '.archiveinfo', 'chat.db'))
+
+            # Histories from before the indexed store are imported once
+            if self.p.local.is_path_valid('.archiveinfo/chat.json'):
+                chat_json_path = os.path.join(self.p.local_path, '.archiveinfo', 'chat.json')
+                self.store.import_json(chat_json_path)
+                os.replace(chat_json_path, chat_json_path + '.imported')
             # self.refresh()
 
+            self._public_keys = {}
+
+        def get_public_key(self, user:str):
+            """Returns the parsed public key of `user`, downloading it again only when it was replaced"""
+            key_path = f'archiveinfo/users/{user}/public.asc'
+            key_id = self.p.remote.get_path_id(key_path)
+            cached = self._public_keys.get(user)
+            if cached is None or cached[0] != key_id:
+                cached = (key_id, rsa.load_public_key(self.p.remote.get_file_data(key_path)))
+                self._public_keys[user] = cached
+            return cached[1]
+
         def send_message(self, recipient:str, message:str):
             if not self.p.remote.is_valid_path(f'archiveinfo/users/{recipient}'):
                 raise ValueError(f"User {recipient} does not exist")
 
-            self.p.remote.create_folder(f'archiveinfo/users/{recipient}/messages')
-            self.p.remote.create_folder(f'archiveinfo/users/{recipient}/messages/{self.p.username}')
+            self.p.remote.require_folders([
+                f'archiveinfo/users/{recipient}/messages',
+                f'archiveinfo/users/{recipient}/messages/{self.p.username}'
+            ])
 
-            public_key = self.p.remote.get_file_data(f'archiveinfo/users/{recipient}/public.asc')
+            public_key = self.get_public_key(recipient)
 
             message_id = secrets.token_urlsafe(24)
             message_data = {
@@ -261,19 +804,16 @@ class Drive:
                 "sender": self.p.username
             }
 
-            encrypted_data = rsa.encrypt(json.dumps(message_data).encode(), public_key)
+            encrypted_data = rsa.encrypt_hybrid(json.dumps(message_data).encode(), public_key)
 
             self.p.remote.create_file(f'archiveinfo/users/{recipient}/messages/{self.p.username}/{message_id}.acs', encrypted_data)
-            messages = self.messages
-            if not recipient in messages.keys():
-                messages[recipient] = {}
-            messages[recipient][message_id] = message_data
-
-            self.p.local.write_file('.archiveinfo/chat.json', json.dumps(messages).encode())
+            self.store.add(recipient, message_id, message_data)
 
         def refresh(self, force_download:bool=False):
+            """Downloads messages that are not in the local store yet and returns them"""
             self.p.remote.map_structure()
-            messages = self.messages
+            messages = {}
+            private_key = self.p.km.get_private_key('user/private')
 
 
             for user in self.p.users:
@@ -281,20 +821,17 @@ class Drive:
                 if not message_dir:
                     continue
 
-                if not user in messages.keys():
-                    messages[user] = {}
+                messages[user] = {}
+                known_message_ids = self.store.message_ids(user)
 
                 for message_filename in message_dir['children']:
                     message_id = message_filename.removesuffix('.acs')
-                    if force_download or (message_id not in messages[user].keys()):
+                    if force_download or (message_id not in known_message_ids):
                         encrypted_data = self.p.remote.get_file_data(
                             f'archiveinfo/users/{self.p.username}/messages/{user}/{message_filename}'
                         )
                         message_data:dict[str, str|int] = json.loads(
-                            rsa.decrypt(
-                                encrypted_data,
-                                self.p.km.get_key('user/private')
-                            ).decode()
+                            rsa.decrypt_hybrid(encrypted_data, private_key).decode()
                         )
                         
                         if message_data['content'].startswith(KEY_DELIMITER):
@@ -316,18 +853,19 @@ class Drive:
                         }
                         messages[user][message_id] = message_obj
 
-
-            
-            self.p.local.write_file('.archiveinfo/chat.json', json.dumps(messages).encode())
+                self.store.add_many([
+                    (user, message_id, message_obj) for message_id, message_obj in messages[user].items()
+                ])
             
             return messages
         
         @property
-        def messages(self):
-            return json.loads(self.p.local.get_file_data('.archiveinfo/chat.json'))
+        def messages(self) -> dict[str, dict[str, dict]]:
+            return {peer: self.store.get_messages(peer) for peer in self.store.peers()}
     
-        def get_messages(self, user:str) -> dict[str, dict[str, str]]:
-            messages:dict[str, dict[str, str]] = self.messages.get(user, {})
+        def get_messages(self, user:str, since:float=None, until:float=None, limit:int=None) -> dict[str, dict[str, str]]:
+            """Messages exchanged with `user` in `[since, until)`, or the newest `limit` of them, oldest first"""
+            messages:dict[str, dict[str, str]] = self.store.get_messages(user, since, until, limit)
             updated_messages = {}
             for message_id, message in messages.items():
 
@@ -359,82 +897,659 @@ class Drive:
     def send_archive_key(self, user:str):
         self.chat.send_message(user, KEY_DELIMITER+self.km.get_key(f'archives/{self.id}').decode())
 
-    def hash_files(self) -> dict[str]:
-        all_files = self.local.all_files
+    def _hash_names(self, names:list[str], remote_file_hashes:dict=None, defer:bool=False) -> dict[str]:
+        """Returns the digests of `names`, only reading the files whose cached digest is stale
+
+        Files with an entry in `remote_file_hashes` are hashed with the algorithm
+        of that entry, so they can be compared with it directly. With `defer`,
+        cached digests of any algorithm are returned, and stale files are not read
+        but get `None`, for push to hash them on the way.
+        """
         data_hashes = {}
-        for file in all_files:
-            if not file.startswith('.'):
-                self.local.get_file_data(file)
-                data_hashes[file] = urlsafe_b64encode(hash_md5(self.local.get_file_data(file))).decode()
+        stats = {}
+        missing:dict[str, list[str]] = {}
+        for name in names:
+            try:
+                stat = self.file_index.stat(name)
+            except FileNotFoundError:
+                continue
+            algorithm = self.hash_algorithm
+            if remote_file_hashes and name in remote_file_hashes and algorithm_of(remote_file_hashes[name]) in HASH_ALGORITHMS:
+                algorithm = algorithm_of(remote_file_hashes[name])
+
+            data_hash = self.file_index.lookup(name, stat)
+            if data_hash is not None and (algorithm_of(data_hash) == algorithm or defer):
+                # Push compares digests of other algorithms itself, see `_changed_files`
+                data_hashes[name] = data_hash
+            elif defer:
+                data_hashes[name] = None
+            else:
+                stats[name] = stat
+                missing.setdefault(algorithm, []).append(name)
+
+        for algorithm, missing_names in missing.items():
+            digests = self.hasher.digest_files([os.path.join(self.local_path, name) for name in missing_names], algorithm)
+            for name, data_hash in zip(missing_names, digests.values()):
+                if isinstance(data_hash, FileNotFoundError):
+                    # Deleted since it was listed
+                    continue
+                elif isinstance(data_hash, Exception):
+                    raise data_hash
+                data_hashes[name] = data_hash
+                self.file_index.update(name, stats[name], data_hash)
+        return data_hashes
 
+    def hash_files(self, remote_file_hashes:dict=None, defer:bool=False) -> dict[str]:
+        with self.metrics.phase('hash'):
+            all_files = [file for file in self.local.all_files if not file.startswith('.')]
+            data_hashes = self._hash_names(all_files, remote_file_hashes, defer)
+
+            self.file_index.prune(set(all_files))
+            self.file_index.save()
+        return data_hashes
+
+    def hash_paths(self, paths:set[str], remote_file_hashes:dict=None, defer:bool=False) -> dict[str]:
+        """Hashes the files among `paths` that exist, and every file inside the folders among them"""
+        names = []
+        with self.metrics.phase('hash'):
+            for path in paths:
+                if path.startswith('.'):
+                    continue
+                full_path = os.path.join(self.local_path, path)
+                if os.path.isdir(full_path):
+                    for root, _, files in os.walk(full_path):
+                        for file in files:
+                            names.append(os.path.relpath(os.path.join(root, file), self.local_path).replace('\\', '/'))
+                elif os.path.isfile(full_path):
+                    names.append(path)
+            data_hashes = self._hash_names(names, remote_file_hashes, defer)
+
+            self.file_index.save()
         return data_hashes
 
+    def _changed_files(self, names, local_data_hashes:dict, remote_file_hashes:dict) -> list[str]:
+        """Returns the names among `names` whose local content differs from their remote entry
+
+        Digests computed with different algorithms, e.g. after `hash_algorithm`
+        was changed, are compared by hashing the local file again with the
+        algorithm of the remote entry.
+        """
+        changed = []
+        rehash:dict[str, list[str]] = {}
+        for name in names:
+            local_hash, remote_hash = local_data_hashes.get(name), remote_file_hashes.get(name)
+            if local_hash is None or remote_hash is None:
+                # Unknown local digests are settled while the file is pushed
+                changed.append(name)
+                continue
+            if local_hash == remote_hash:
+                continue
+            algorithm = algorithm_of(remote_hash)
+            if algorithm == algorithm_of(local_hash) or algorithm not in HASH_ALGORITHMS:
+                changed.append(name)
+            else:
+                rehash.setdefault(algorithm, []).append(name)
+
+        for algorithm, rehash_names in rehash.items():
+            digests = self.hasher.digest_files([os.path.join(self.local_path, name) for name in rehash_names], algorithm)
+            changed.extend(
+                name for name, data_hash in zip(rehash_names, digests.values())
+                if data_hash != remote_file_hashes[name]
+            )
+        return changed
+
     def get_remote_file_hashes(self) -> dict:
-        try:
-            return json.loads(self.remote.get_file_data('archiveinfo/file_hashes.json', is_encrypted=True).decode())
-        except ValueError:
-            return {}
+        with self.metrics.phase('manifest_load'):
+            return self.file_hashes.load()
 
     def update_remote_file_hashes(self, data_hashes:dict):
-        self.remote.delete_file('archiveinfo/file_hashes.json')
-        self.remote.create_file('archiveinfo/file_hashes.json', json.dumps(data_hashes).encode(), should_encrypt=True)
+        with self.metrics.phase('manifest_update'):
+            self.file_hashes.update(data_hashes)
+
+    @contextmanager
+    def _metered(self, operation:str):
+        """Collects the metrics of `operation` and writes its report once it finishes, also when it fails"""
+        outermost = False
+        try:
+            with self.metrics.run(operation) as outermost:
+                if outermost and getattr(self.storage, 'scheduler', None):
+                    # Filled in by the calls this drive makes, see `MeteredStorage`
+                    self.metrics.backend = {'requests': {}, 'retries': 0, 'throttles': 0}
+                yield
+        finally:
+            if outermost:
+                # Keeps the folders listed during the run for the next session
+                self.remote.save_snapshot()
+            if outermost and self.metrics_enabled:
+                self._save_metrics()
+
+    def _save_metrics(self):
+        report = self.metrics.report()
+        try:
+            write_report(report, os.path.join(self.local_path, '.archiveinfo', 'metrics'), self.metrics_history)
+            if self.metrics_textfile_dir:
+                write_prometheus(
+                    report,
+                    os.path.join(self.metrics_textfile_dir, f"ceased-{self.id}-{report['operation']}.prom"),
+                    {'archive': self.id, 'local_path': self.local_path}
+                )
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
 
     def _hash_filename(self, filename:str) -> str:
         return urlsafe_b64encode(hash_sha256(filename.encode()+self.salt)).decode()
 
-    def pull(self):
-        self.remote.map_structure()
+    def _chunk_name(self, chunk:bytes) -> str:
+        return urlsafe_b64encode(hash_sha256(hash_sha256(chunk)+self.salt)).decode()
 
-        local_data_hashes = self.hash_files()
-        remote_file_hashes = self.get_remote_file_hashes()
+    def _upload_chunk(self, chunk:bytes) -> str:
+        """Uploads a chunk unless it is already stored and returns its name"""
+        chunk_name = self._chunk_name(chunk)
+        with self._chunk_lock:
+            upload = self._chunk_uploads.get(chunk_name)
+            owner = upload is None and not self.remote.is_valid_path(f'files/{chunk_name}')
+            if owner:
+                upload = self._chunk_uploads[chunk_name] = threading.Event()
 
-        for filename, data_hash in remote_file_hashes.items():
-            if local_data_hashes.get(filename) != data_hash:
-                data = self.remote.get_file_data(f'files/{self._hash_filename(filename)}', is_encrypted=True)
-                self.local.write_file(filename, data)
-                print(f"File pulled: {filename}")
+        if upload is None:
+            return chunk_name
+
+        if not owner:
+            # Another file is uploading the same chunk right now
+            upload.wait()
+            if not self.remote.is_valid_path(f'files/{chunk_name}'):
+                raise IOError(f"Upload of chunk {chunk_name} failed")
+            return chunk_name
 
+        try:
+            self.remote.upload_encrypted(f'files/{chunk_name}', io.BytesIO(chunk), len(chunk))
+        finally:
+            with self._chunk_lock:
+                del self._chunk_uploads[chunk_name]
+            upload.set()
+        return chunk_name
+
+    def pull_chunked_file(self, name:str, chunk_names:list[str]):
+        """Rebuilds a file from its chunk list, only downloading chunks the local copy doesn't have"""
+        local_file_path = os.path.join(self.local_path, name)
+        local_chunks = {}
+        if os.path.isfile(local_file_path):
+            offset = 0
+            with open(local_file_path, 'rb') as f:
+                for chunk in iter_chunks(f):
+                    local_chunks.setdefault(self._chunk_name(chunk), (offset, len(chunk)))
+                    offset += len(chunk)
+
+        # The old copy is closed again before the new one replaces it
+        with self.local.open_atomic(name) as f, ExitStack() as stack:
+            old_file = stack.enter_context(open(local_file_path, 'rb')) if local_chunks else None
+            for chunk_name in chunk_names:
+                if chunk_name in local_chunks:
+                    offset, length = local_chunks[chunk_name]
+                    old_file.seek(offset)
+                    f.write(old_file.read(length))
+                else:
+                    self.remote.download_to(f'files/{chunk_name}', f)
+
+    def pull(self, exclude:set[str]=frozenset()) -> dict[str, int]:
+        """Makes the local folder match the archive and returns how many files were pulled, deleted, failed or unchanged
+
+        The files in `exclude` are left as they are.
+        """
+        with self._metered('pull'):
+            self.remote.map_structure()
+
+            remote_file_hashes = self.get_remote_file_hashes()
+            local_data_hashes = self.hash_files(remote_file_hashes)
+            return self._pull_files(local_data_hashes, remote_file_hashes, remote_file_hashes.keys() | local_data_hashes.keys(), exclude)
+
+    def pull_paths(self, paths:set[str], exclude:set[str]=frozenset()) -> dict[str, int]:
+        """Pulls only the given files, or the files inside the given folders"""
+        with self._metered('pull_paths'):
+            self.remote.map_structure()
+
+            remote_file_hashes = self.get_remote_file_hashes()
+            local_data_hashes = self.hash_paths(paths, remote_file_hashes)
+            names = {
+                name for name in remote_file_hashes
+                if any(name == path or name.startswith(path + '/') for path in paths)
+            }
+            return self._pull_files(local_data_hashes, remote_file_hashes, names | local_data_hashes.keys(), exclude)
+
+    def pull_changes(self, exclude:set[str]=frozenset()) -> dict[str, int]:
+        """Pulls the files whose remote entry changed since the file list was last loaded
+
+        Costs a single change listing when nobody else pushed in the meantime.
+        """
+        with self._metered('pull_changes'):
+            self.remote.map_structure()
+            if self.file_hashes.is_current():
+                return {'pulled': 0, 'deleted': 0, 'failed': 0, 'unchanged': len(self.file_hashes.entries)}
+
+            previous_hashes = self.file_hashes.entries
+            remote_file_hashes = self.get_remote_file_hashes()
+            changed = {
+                name for name in previous_hashes.keys() | remote_file_hashes.keys()
+                if previous_hashes.get(name) != remote_file_hashes.get(name)
+            }
+            counts = self.pull_paths(changed, exclude) if changed else {'pulled': 0, 'deleted': 0, 'failed': 0, 'unchanged': 0}
+            counts['unchanged'] += len(remote_file_hashes.keys() - changed)
+            return counts
+
+    def _pull_files(self, local_data_hashes:dict, remote_file_hashes:dict, names:set[str], exclude:set[str]=frozenset()) -> dict[str, int]:
+        """Makes the local copies of `names`, except those in `exclude`, match `remote_file_hashes`"""
+        names = {name for name in names if name not in exclude}
+        counts = {'pulled': 0, 'deleted': 0, 'failed': 0, 'unchanged': 0}
+        with self.metrics.phase('manifest_load'):
+            chunk_index = self.chunk_index.load()
+            pack_index = self.pack_index.load()
+        pack_errors:dict[str, Exception] = {}
+
+        def pull_single_file(filename:str):
+            if filename in chunk_index:
+                self.pull_chunked_file(filename, chunk_index[filename])
+            else:
+                with self.local.open_atomic(filename) as f:
+                    self.remote.download_to(f'files/{self._hash_filename(filename)}', f)
+            self.file_index.update(filename, self.file_index.stat(filename), remote_file_hashes[filename])
+
+        def pull_pack(pack_name:str):
+            """Downloads a pack once and writes out each of its members that changed"""
+            with tempfile.SpooledTemporaryFile(max_size=COMPRESSION_SPOOL_SIZE, dir=self.local.temp_folder) as pack:
+                self.remote.download_to(f'files/{pack_name}', pack)
+                for filename in packs[pack_name]:
+                    _, offset, length, _ = pack_index[filename]
+                    try:
+                        pack.seek(offset)
+                        with self.local.open_atomic(filename) as f:
+                            f.write(pack.read(length))
+                        self.file_index.update(filename, self.file_index.stat(filename), remote_file_hashes[filename])
+                    except Exception as e:
+                        pack_errors[filename] = e
+
+        def finish(filename:str, error:Exception):
+            if error:
+                print(f"Error pulling file `{filename}`: {error}")
+                counts['failed'] += 1
+            else:
+                print(f"File pulled: {filename}")
+                counts['pulled'] += 1
 
-        for filename in local_data_hashes.keys():
-            if filename not in remote_file_hashes.keys():
-                self.local.delete_file(filename)
-                print(f"File deleted: {filename}")
+        changed_files = self._changed_files(
+            [filename for filename in names if filename in remote_file_hashes], local_data_hashes, remote_file_hashes
+        )
+        counts['unchanged'] = sum(1 for filename in names if filename in remote_file_hashes) - len(changed_files)
+        packs:dict[str, list[str]] = {}
+        for filename in changed_files:
+            if filename in pack_index:
+                packs.setdefault(pack_index[filename][0], []).append(filename)
+        with self.metrics.phase('transfer'):
+            single_files = (filename for filename in changed_files if filename not in pack_index)
+            for filename, error in run_bounded(pull_single_file, single_files, self.pull_workers):
+                finish(filename, error)
+            for pack_name, error in run_bounded(pull_pack, packs, self.pull_workers):
+                for filename in packs[pack_name]:
+                    finish(filename, error or pack_errors.get(filename))
+
+
+        deleted_files = (filename for filename in names if filename in local_data_hashes and filename not in remote_file_hashes)
+        with self.metrics.phase('delete'):
+            for filename, error in run_bounded(self.local.delete_file, deleted_files, self.pull_workers):
+                if error:
+                    print(f"Error deleting file `{filename}`: {error}")
+                    counts['failed'] += 1
+                else:
+                    print(f"File deleted: {filename}")
+                    counts['deleted'] += 1
+
+        self.file_index.save()
+        self.metrics.add_counts('files', counts)
+        return counts
     
-    def push(self):
-        self.remote.map_structure()
+    def push(self) -> dict[str, int]:
+        """Makes the archive match the local folder and returns how many files were pushed, deleted, failed or unchanged"""
+        with self._metered('push'):
+            self.remote.map_structure()
 
-        local_data_hashes = self.hash_files()
-        remote_file_hashes = self.get_remote_file_hashes()
+            # Changed files are hashed while they are uploaded, so they are only read once
+            local_data_hashes = self.hash_files(defer=True)
+            remote_file_hashes = self.get_remote_file_hashes()
 
+            return self._push_files(local_data_hashes, remote_file_hashes)
 
-        def sync_single_file(name:str, data_hash:str):
-            if remote_file_hashes.get(name) != data_hash:
-                data = self.local.get_file_data(name)
-                hashed_name = self._hash_filename(name)
-                self.remote.delete_file(f'files/{hashed_name}')
-                self.remote.create_file(f'files/{hashed_name}', data, should_encrypt=True)
-        
-        with ThreadPoolExecutor() as executor:
-            futures = {}
-            for name, data_hash in local_data_hashes.items():
-                future = executor.submit(sync_single_file, name, data_hash)
-                futures[future] = name
-
-        for future in as_completed(futures):
-            name = futures[future]
+    def push_paths(self, paths:set[str]) -> dict[str, int]:
+        """Pushes only the given files or folders, and removes the remote copies of those that are gone"""
+        with self._metered('push_paths'):
+            self.remote.map_structure()
+
+            local_data_hashes = self.hash_paths(paths, defer=True)
+            remote_file_hashes = self.get_remote_file_hashes()
+
+            target_hashes = dict(remote_file_hashes)
+            for path in paths:
+                if os.path.isfile(os.path.join(self.local_path, path)):
+                    continue
+                for name in remote_file_hashes:
+                    if (name == path or name.startswith(path + '/')) and name not in local_data_hashes:
+                        target_hashes.pop(name, None)
+            target_hashes.update(local_data_hashes)
+
+            return self._push_files(target_hashes, remote_file_hashes)
+
+    def _digest_data(self, data:bytes, remote_hash:str|None) -> tuple[str, bool]:
+        """Returns the digest of `data` and whether it matches `remote_hash`, which may use another algorithm"""
+        data_hash = self.hasher.digest_bytes(data)
+        if remote_hash is None or algorithm_of(remote_hash) not in HASH_ALGORITHMS:
+            return data_hash, False
+        if algorithm_of(remote_hash) != self.hash_algorithm:
+            return data_hash, self.hasher.digest_bytes(data, algorithm_of(remote_hash)) == remote_hash
+        return data_hash, data_hash == remote_hash
+
+    def _push_file(self, name:str, data_hash:str|None, remote_hash:str|None) -> tuple[str, list[str]|None, bool]:
+        """Uploads a file and returns its digest, its chunk list if it is stored in chunks, and whether it was transferred
+
+        A file whose digest is not known yet (`data_hash` is `None`) is hashed on
+        the way, so it is read once. Files smaller than a transfer chunk are read
+        into memory and only uploaded when they differ from `remote_hash`. Larger
+        ones are hashed before the upload when `remote_hash` is known, and skipped
+        if they match. Otherwise they are hashed while they are compressed and
+        encrypted.
+        """
+        local_file_path = os.path.join(self.local_path, name)
+        remote_path = f'files/{self._hash_filename(name)}'
+        stat = self.file_index.stat(name)
+        source = self.remote.upload_source(local_file_path)
+
+        algorithms = {self.hash_algorithm}
+        if remote_hash is not None and algorithm_of(remote_hash) in HASH_ALGORITHMS:
+            algorithms.add(algorithm_of(remote_hash))
+
+        chunk_names = None
+        transferred = True
+        digests = None
+        with open(local_file_path, 'rb') as f:
+            reader = None if data_hash is not None else self.hasher.reader(f, stat.st_size, algorithms)
+            if self.chunked_storage and stat.st_size >= self.chunked_storage_min_size:
+                # Chunks that are stored already are not uploaded again, so unchanged files cost no transfer
+                chunk_names = [self._upload_chunk(chunk) for chunk in iter_chunks(reader or f)]
+                # Left over from when the file was stored whole
+                self.remote.delete_file(remote_path)
+            elif reader is not None and stat.st_size < self.transfer_chunk_size:
+                data = f.read()
+                data_hash, unchanged = self._digest_data(data, remote_hash)
+                digests = {self.hash_algorithm: data_hash}
+                if unchanged:
+                    transferred = False
+                else:
+                    # Changed files are updated in place, only new paths are created
+                    self.remote.upload_encrypted(remote_path, io.BytesIO(data), len(data), source, overwrite=True)
+            else:
+                if reader is not None and remote_hash is not None and algorithm_of(remote_hash) in HASH_ALGORITHMS:
+                    # Reading the file once is cheaper than compressing, encrypting and sending most of it
+                    digests = self.hasher.digest_stream(f, algorithms)
+                    f.seek(0)
+                    if digests[algorithm_of(remote_hash)] == remote_hash:
+                        transferred = False
+                    else:
+                        # Hashed again while it is uploaded, in case it changes in between
+                        digests = None
+                if transferred:
+                    self.remote.upload_encrypted(remote_path, reader or f, source['size'], source, overwrite=True)
+
+        if data_hash is None:
+            digests = digests or reader.digests
+            if digests is not None:
+                data_hash = digests[self.hash_algorithm]
+            else:
+                # A resumed upload skipped the bytes sent before the restart
+                data_hash = self.hasher.digest_file(local_file_path)
+            self.file_index.update(name, stat, data_hash)
+        return data_hash, chunk_names, transferred
+
+    def _file_size(self, name:str) -> int|None:
+        try:
+            return os.path.getsize(os.path.join(self.local_path, name))
+        except OSError:
+            return None
+
+    def _push_weight(self, name:str) -> int:
+        """Estimates the bytes pushing `name` holds in memory at its peak
+
+        Files smaller than a transfer chunk are read whole, larger ones are streamed
+        through a compression spool and an upload buffer of bounded size.
+        """
+        size = self._file_size(name)
+        if size is None:
+            return 0
+        if self.chunked_storage and size >= self.chunked_storage_min_size:
+            return 3 * MAX_CHUNK_SIZE
+        return 2 * min(size, self.transfer_chunk_size) + min(size, COMPRESSION_SPOOL_SIZE)
+
+    def _pack_members(self, changed_files:list[str], local_data_hashes:dict, pack_index:dict) -> list[tuple[str, int, list|None]]:
+        """Returns the `(name, size, pack entry)` of every file to write into a new pack
+
+        These are the changed files smaller than `pack_threshold`, without a pack
+        entry, followed by the remaining files of packs whose dead space exceeds
+        `repack_dead_ratio`. Files whose digest is not known yet count as live, but
+        they are pushed like the other changed files instead of being repacked.
+        """
+        if not self.pack_small_files:
+            return []
+
+        members = []
+        for name in changed_files:
+            size = self._file_size(name)
+            if size is not None and size < self.pack_threshold:
+                members.append((name, size, None))
+
+        changed = set(changed_files)
+        live_files:dict[str, list[str]] = {}
+        for name, entry in pack_index.items():
+            if name not in changed or local_data_hashes[name] is None:
+                live_files.setdefault(entry[0], []).append(name)
+        for names in live_files.values():
+            pack_size = pack_index[names[0]][3]
+            if sum(pack_index[name][2] for name in names) < pack_size * (1 - self.repack_dead_ratio):
+                members.extend((name, pack_index[name][2], pack_index[name]) for name in names if name not in changed)
+        return members
+
+    def _pack_batches(self, members:list[tuple[str, int, list|None]]):
+        """Groups pack members into batches of about `pack_size` bytes, one pack each"""
+        batch, batch_size = [], 0
+        for member in members:
+            if batch and batch_size + member[1] > self.pack_size:
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(member)
+            batch_size += member[1]
+        if batch:
+            yield batch
+
+    def _pack_weight(self, batch:list[tuple[str, int, list|None]]) -> int:
+        # The pack is built next to the contents it is built from, plus the old packs members are copied out of
+        old_packs = {pack_entry[0] for _, _, pack_entry in batch if pack_entry is not None}
+        return 2 * sum(size for _, size, _ in batch) + len(old_packs) * self.pack_size
+
+    def _push_pack(self, batch:list[tuple[str, int, list|None]], local_data_hashes:dict, remote_file_hashes:dict) -> dict[str, tuple|Exception]:
+        """Writes the members of `batch` into a new pack and returns their `(digest, pack entry)`, or the error they failed with
+
+        Members without a pack entry are read from the local folder. If their digest
+        was not known yet and turns out to match `remote_file_hashes`, they are left
+        out and their pack entry is `None`. Members of an old pack are copied out of it.
+        """
+        results = {}
+        old_packs = {}
+        for pack_name in {pack_entry[0] for _, _, pack_entry in batch if pack_entry is not None}:
             try:
-                future.result()
-                print(f"File pushed: {name}")
+                stream = io.BytesIO()
+                self.remote.download_to(f'files/{pack_name}', stream)
+                old_packs[pack_name] = stream.getvalue()
             except Exception as e:
-                print(f"Error pushing file `{name}`: {e}")
+                old_packs[pack_name] = e
 
+        pack = bytearray()
+        entries = {}
+        for name, _, pack_entry in batch:
+            try:
+                if pack_entry is None:
+                    stat = self.file_index.stat(name)
+                    with open(os.path.join(self.local_path, name), 'rb') as f:
+                        data = f.read()
+                    data_hash = local_data_hashes[name]
+                    if data_hash is None:
+                        data_hash, unchanged = self._digest_data(data, remote_file_hashes.get(name))
+                        self.file_index.update(name, stat, data_hash)
+                        if unchanged:
+                            results[name] = (data_hash, None)
+                            continue
+                else:
+                    old_pack = old_packs[pack_entry[0]]
+                    if isinstance(old_pack, Exception):
+                        raise old_pack
+                    data_hash, data = local_data_hashes[name], old_pack[pack_entry[1]:pack_entry[1]+pack_entry[2]]
+            except Exception as e:
+                results[name] = e
+                continue
+            entries[name] = (data_hash, len(pack), len(data))
+            pack += data
 
-        for name in remote_file_hashes:
-            if not (name in local_data_hashes.keys()):
-                hashed_name = self._hash_filename(name)
-                self.remote.delete_file(f'files/{hashed_name}')
+        if entries:
+            pack_name = f'pack-{secrets.token_urlsafe(16)}'
+            try:
+                self.remote.upload_encrypted(f'files/{pack_name}', io.BytesIO(pack), len(pack))
+            except Exception as e:
+                results.update((name, e) for name in entries)
+                return results
+            for name, (data_hash, offset, length) in entries.items():
+                results[name] = (data_hash, [pack_name, offset, length, len(pack)])
+        return results
+
+    def _push_files(self, local_data_hashes:dict, remote_file_hashes:dict) -> dict[str, int]:
+        """Makes the remote archive match `local_data_hashes`, the complete new file list
+
+        Files whose digest is `None` are hashed while they are pushed.
+        """
+        counts = {'pushed': 0, 'deleted': 0, 'failed': 0, 'unchanged': len(local_data_hashes)}
+        self.push_failures = set()
+        if local_data_hashes == remote_file_hashes:
+            self.metrics.add_counts('files', counts)
+            return counts
+
+        with self.metrics.phase('manifest_load'):
+            chunk_index = self.chunk_index.load()
+            pack_index = self.pack_index.load()
+        new_chunk_index = {name: chunk_names for name, chunk_names in chunk_index.items() if name in local_data_hashes}
+        new_pack_index = {name: pack_entry for name, pack_entry in pack_index.items() if name in local_data_hashes}
+
+        changed_files = self._changed_files(local_data_hashes, local_data_hashes, remote_file_hashes)
+        counts['unchanged'] -= len(changed_files)
+        failed_files = set()
+        local_data_hashes = dict(local_data_hashes)
+
+        # Small files go into packs, every other file is stored on its own
+        pack_members = self._pack_members(changed_files, local_data_hashes, new_pack_index)
+        packed_files = {name for name, _, pack_entry in pack_members if pack_entry is None}
+        # Previous copies of newly packed files, deleted once the manifests no longer refer to them
+        unpacked_objects = []
+
+        def sync_single_file(name:str) -> bool:
+            data_hash, chunk_names, transferred = self._push_file(name, local_data_hashes[name], remote_file_hashes.get(name))
+            local_data_hashes[name] = data_hash
+            if chunk_names is not None:
+                new_chunk_index[name] = chunk_names
+            else:
+                new_chunk_index.pop(name, None)
+            new_pack_index.pop(name, None)
+            return transferred
+
+        with self.metrics.phase('transfer'):
+            single_files = [name for name in changed_files if name not in packed_files]
+            results = run_budgeted(sync_single_file, single_files, self._push_weight, self.push_memory_budget, self.push_workers)
+            for name, transferred, error in results:
+                if error:
+                    print(f"Error pushing file `{name}`: {error}")
+                    failed_files.add(name)
+                elif transferred:
+                    print(f"File pushed: {name}")
+                    counts['pushed'] += 1
+                else:
+                    counts['unchanged'] += 1
+
+            results = run_budgeted(
+                lambda batch: self._push_pack(batch, local_data_hashes, remote_file_hashes),
+                self._pack_batches(pack_members), self._pack_weight, self.push_memory_budget, self.push_workers
+            )
+            for batch, batch_results, error in results:
+                for name, _, pack_entry in batch:
+                    result = error or batch_results[name]
+                    if isinstance(result, Exception):
+                        if pack_entry is None:
+                            print(f"Error pushing file `{name}`: {result}")
+                            failed_files.add(name)
+                        else:
+                            # Stays in its old pack until the next push
+                            print(f"Error repacking file `{name}`: {result}")
+                        continue
+
+                    data_hash, new_pack_entry = result
+                    local_data_hashes[name] = data_hash
+                    if new_pack_entry is None:
+                        counts['unchanged'] += 1
+                        continue
+                    new_pack_index[name] = new_pack_entry
+                    if pack_entry is None:
+                        new_chunk_index.pop(name, None)
+                        unpacked_objects.append(f'files/{self._hash_filename(name)}')
+                        print(f"File pushed: {name}")
+                        counts['pushed'] += 1
+
+
+        deleted_files = {f'files/{self._hash_filename(name)}': name for name in remote_file_hashes if name not in local_data_hashes}
+        with self.metrics.phase('delete'):
+            delete_errors = self.remote.delete_files(list(deleted_files))
+        for path, name in deleted_files.items():
+            if path in delete_errors:
+                print(f"Error deleting remote file `{name}`: {delete_errors[path]}")
+                failed_files.add(name)
+            else:
                 print(f"Remote file deleted: {name}")
+                counts['deleted'] += 1
+
+        # Files that failed keep their previous manifest entry so the next push retries them
+        pushed_hashes = {name: data_hash for name, data_hash in local_data_hashes.items() if name not in failed_files and data_hash is not None}
+        for name in failed_files:
+            if name in remote_file_hashes:
+                pushed_hashes[name] = remote_file_hashes[name]
+
+        self.update_remote_file_hashes(pushed_hashes)
 
-        self.update_remote_file_hashes(local_data_hashes)
+        if new_chunk_index != chunk_index:
+            with self.metrics.phase('manifest_update'):
+                self.chunk_index.update(new_chunk_index)
+
+            # Chunks no file refers to anymore
+            referenced_chunks = {chunk_name for chunk_names in new_chunk_index.values() for chunk_name in chunk_names}
+            unused_chunks = {
+                f'files/{chunk_name}' for chunk_names in chunk_index.values() for chunk_name in chunk_names
+                if chunk_name not in referenced_chunks
+            }
+            for path, error in self.remote.delete_files(list(unused_chunks)).items():
+                print(f"Error deleting unused chunk `{path}`: {error}")
+
+        if new_pack_index != pack_index:
+            with self.metrics.phase('manifest_update'):
+                self.pack_index.update(new_pack_index)
+
+            # Packs no file refers to anymore, along with the copies packed files replaced
+            referenced_packs = {pack_entry[0] for pack_entry in new_pack_index.values()}
+            unused_packs = {f'files/{pack_entry[0]}' for pack_entry in pack_index.values() if pack_entry[0] not in referenced_packs}
+            for path, error in self.remote.delete_files(list(unused_packs) + unpacked_objects).items():
+                print(f"Error deleting unused pack `{path}`: {error}")
+
+        self.file_index.save()
+        self.push_failures = failed_files
+        counts['failed'] = len(failed_files)
+        self.metrics.add_counts('files', counts)
+        return counts
 
     
\ No newline at end of file
@@ -0,0 +1,124 @@
+import os
+import time
+import secrets
+import threading
+import ujson as json
+
+
+# Google Drive keeps an unfinished resumable upload for about a week
+SESSION_LIFETIME = 6 * 24 * 60 * 60
+NONCE_PREFIX_LENGTH = 7
+
+
+class UploadSession:
+    """Progress of one resumable upload
+
+    `nonce_prefix` is reused when the upload is resumed, so the bytes still to
+    be sent are encrypted exactly like the ones the server already has. Every
+    checkpoint also records a digest of the plaintext behind those bytes, which
+    has to match before the upload is resumed.
+    """
+
+    def __init__(self, store:'UploadSessions', remote_path:str, entry:dict) -> None:
+        self.store = store
+        self.remote_path = remote_path
+        self.entry = entry
+        self.reader = None
+
+    @property
+    def uri(self) -> str|None:
+        return self.entry.get('uri')
+
+    @property
+    def offset(self) -> int:
+        return self.entry.get('offset', 0)
+
+    @property
+    def nonce_prefix(self) -> bytes:
+        return bytes.fromhex(self.entry['nonce_prefix'])
+
+    def attach(self, reader) -> bool:
+        """Ties the session to the `EncryptingReader` that produces its bytes
+
+        Returns False if the bytes the server already has were made from other
+        plaintext, or can't be checked. The session then has to be restarted.
+        """
+        self.reader = reader
+        if not self.offset:
+            return True
+        return self.entry.get('records') == reader.records_digest(self.offset)
+
+    def checkpoint(self, uri:str, offset:int):
+        """Saves the session uri, the number of bytes the server confirmed and the digest of their plaintext"""
+        records = self.reader.records_digest(offset) if self.reader is not None else None
+        with self.store.lock:
+            self.entry['uri'] = uri
+            self.entry['offset'] = offset
+            self.entry['records'] = records
+        self.store.save()
+
+    def restart(self):
+        """Forgets an expired session; the upload starts over with a new nonce prefix"""
+        with self.store.lock:
+            self.entry.pop('uri', None)
+            self.entry.pop('offset', None)
+            self.entry.pop('records', None)
+            self.entry['nonce_prefix'] = secrets.token_bytes(NONCE_PREFIX_LENGTH).hex()
+            self.entry['created'] = time.time()
+        self.store.save()
+
+
+class UploadSessions:
+    """Resumable uploads in progress, persisted so they survive a restart.
+
+    Sessions are keyed by remote path and tied to the `source` they were started
+    for (size, mtime and inode of the local file, compression settings). A
+    session is only resumed while its source is unchanged.
+    """
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries:dict[str, dict] = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+        self.entries = {
+            remote_path: entry for remote_path, entry in self.entries.items()
+            if time.time() - entry['created'] < SESSION_LIFETIME
+        }
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries).encode()
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+
+    def is_resumable(self, remote_path:str, source:dict) -> bool:
+        entry = self.entries.get(remote_path)
+        return (
+            entry is not None and 'uri' in entry and entry['source'] == source
+            and time.time() - entry['created'] < SESSION_LIFETIME
+        )
+
+    def open(self, remote_path:str, source:dict) -> UploadSession:
+        """Returns the session to resume for `remote_path`, or a new one"""
+        with self.lock:
+            if not self.is_resumable(remote_path, source):
+                self.entries[remote_path] = {
+                    "source": source,
+                    "nonce_prefix": secrets.token_bytes(NONCE_PREFIX_LENGTH).hex(),
+                    "created": time.time(),
+                }
+            entry = self.entries[remote_path]
+        return UploadSession(self, remote_path, entry)
+
+    def finish(self, remote_path:str):
+        with self.lock:
+            if self.entries.pop(remote_path, None) is None:
+                return
+        self.save()
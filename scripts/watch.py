@@ -0,0 +1,285 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_POLL_INTERVAL = 30.0
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_MAX_ATTEMPTS = 5
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def is_ignored(path:str) -> bool:
+    # Same rule as `Drive.hash_files`, which keeps `.archiveinfo` out of the archive
+    return path.startswith('.')
+
+
+class InotifyWatcher:
+    """Collects the paths changed under `root`, using inotify through ctypes.
+
+    Every folder gets a watch of its own, and folders created or moved in later
+    are watched as soon as their event arrives. Paths are relative to `root`.
+    """
+
+    def __init__(self, root:str) -> None:
+        self.root = os.path.abspath(root)
+        libc_path = ctypes.util.find_library('c')
+        try:
+            self._libc = ctypes.CDLL(libc_path, use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError("inotify is not available on this system")
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self._watches:dict[int, str] = {}
+        self._add_tree('')
+
+    def close(self):
+        os.close(self.fd)
+
+    def _add_watch(self, path:str) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, path)), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # Folders can disappear again before they are watched
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(error, os.strerror(error))
+        self._watches[wd] = path
+        return True
+
+    def _add_tree(self, path:str) -> set[str]:
+        """Watches `path` and every folder below it, and returns the files found in them"""
+        files = set()
+        pending = [path]
+        while pending:
+            folder = pending.pop()
+            if not self._add_watch(folder):
+                continue
+            try:
+                entries = list(os.scandir(os.path.join(self.root, folder)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                entry_path = f'{folder}/{entry.name}' if folder else entry.name
+                if is_ignored(entry_path):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry_path)
+                else:
+                    files.add(entry_path)
+        return files
+
+    def _remove_tree(self, path:str):
+        for wd, folder in list(self._watches.items()):
+            if folder == path or folder.startswith(path + '/'):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._watches[wd]
+
+    def read(self, timeout:float) -> set[str]|None:
+        """Waits up to `timeout` seconds for events and returns the changed paths
+
+        Returns:
+            set[str]|None: the changed paths, or `None` when the kernel queue
+            overflowed and events were lost
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset+_EVENT.size:offset+_EVENT.size+length].rstrip(b'\0')
+                offset += _EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                folder = self._watches.get(wd)
+                if folder is None or not name:
+                    continue
+
+                path = f'{folder}/{os.fsdecode(name)}' if folder else os.fsdecode(name)
+                if is_ignored(path):
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files can land in a new folder before its watch exists
+                        changed.update(self._add_tree(path))
+                    elif mask & IN_MOVED_FROM:
+                        self._remove_tree(path)
+                changed.add(path)
+
+        return None if overflow else changed
+
+
+class WatchDaemon:
+    """Keeps a drive in sync continuously.
+
+    Local changes are collected with inotify and pushed in batches once no new
+    event arrived for `watch_debounce` seconds, or at the latest `watch_max_delay`
+    seconds after the first one. Remote changes are polled every
+    `watch_poll_interval` seconds. Both only touch the paths that changed, and
+    nothing is pulled while local changes are still waiting to be pushed.
+
+    Failed pushes are retried with a delay that doubles up to `watch_max_backoff`
+    seconds. A file that failed `watch_max_attempts` pushes in a row is set aside
+    until it changes again, and pulls leave it alone in the meantime.
+    """
+
+    def __init__(self, drive) -> None:
+        self.drive = drive
+        self.debounce = drive.config.get('watch_debounce', DEFAULT_DEBOUNCE)
+        self.max_delay = drive.config.get('watch_max_delay', DEFAULT_MAX_DELAY)
+        self.poll_interval = drive.config.get('watch_poll_interval', DEFAULT_POLL_INTERVAL)
+        self.max_backoff = drive.config.get('watch_max_backoff', DEFAULT_MAX_BACKOFF)
+        self.max_attempts = drive.config.get('watch_max_attempts', DEFAULT_MAX_ATTEMPTS)
+        # Failed pushes in a row of each file, and the files that were given up on
+        self.attempts:dict[str, int] = {}
+        self.quarantined:set[str] = set()
+
+    def _retry_paths(self, attempted:set[str]|None) -> set[str]:
+        """Counts the failures of the last push of `attempted`, or of every file, and returns the files to push again"""
+        failed = self.drive.push_failures
+        def was_attempted(name:str) -> bool:
+            return attempted is None or any(name == path or name.startswith(path + '/') for path in attempted)
+
+        for name in [name for name in self.attempts.keys() | self.quarantined if name not in failed and was_attempted(name)]:
+            self.attempts.pop(name, None)
+            self.quarantined.discard(name)
+
+        retry = set()
+        for name in failed - self.quarantined:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            if self.attempts[name] >= self.max_attempts:
+                print(f"Giving up on `{name}` after {self.attempts[name]} failed pushes, it is pushed again once it changes")
+                self.quarantined.add(name)
+            else:
+                retry.add(name)
+        return retry
+
+    def _release(self, paths:set[str]):
+        """Gives the set aside files among `paths` another chance, since they changed"""
+        for name in [name for name in self.quarantined if any(name == path or name.startswith(path + '/') for path in paths)]:
+            self.quarantined.discard(name)
+            self.attempts.pop(name, None)
+
+    def run(self, stop_event=None):
+        """Syncs until `stop_event` is set, or forever"""
+        try:
+            watcher = InotifyWatcher(self.drive.local_path)
+        except OSError as e:
+            print(f"File system events unavailable ({e}), falling back to a full push every {self.poll_interval}s")
+            watcher = None
+
+        try:
+            # Catch up on whatever happened while nobody was watching: a full push
+            # right away, then a full pull. Pulling over files whose push failed
+            # would revert or delete them, so every pull waits for a clean push
+            now = time.monotonic()
+            pending:set[str] = set()
+            full_push = True
+            first_event, last_event = now - self.debounce, now
+            catch_up = True
+            next_poll = now
+            retry_delay, retry_at = self.debounce, now
+
+            while stop_event is None or not stop_event.is_set():
+                now = time.monotonic()
+                deadline = next_poll
+                if first_event is not None:
+                    deadline = max(min(last_event + self.debounce, first_event + self.max_delay), retry_at)
+                if watcher is None:
+                    time.sleep(max(0, deadline - now))
+                    paths = None
+                else:
+                    paths = watcher.read(max(0, min(deadline - now, 1.0)))
+
+                now = time.monotonic()
+                if paths is None:
+                    full_push = True
+                    first_event = first_event or now
+                    last_event = now
+                elif paths:
+                    self._release(paths)
+                    pending |= paths
+                    first_event = first_event or now
+                    last_event = now
+
+                if (pending or full_push) and now >= retry_at and (
+                    watcher is None or now - last_event >= self.debounce or now - first_event >= self.max_delay
+                ):
+                    try:
+                        if full_push:
+                            self.drive.push()
+                        else:
+                            self.drive.push_paths(pending)
+                    except Exception as e:
+                        print(f"Error pushing changes: {e}")
+                        failed = True
+                    else:
+                        # Only the files that failed are pushed again
+                        pending, full_push = self._retry_paths(None if full_push else pending), False
+                        failed = bool(pending)
+                    if failed:
+                        print(f"Pushing again in {retry_delay:g}s")
+                        retry_at = now + retry_delay
+                        retry_delay = min(retry_delay * 2, self.max_backoff)
+                        first_event = last_event = now
+                    else:
+                        retry_delay, retry_at = self.debounce, now
+                        first_event = last_event = None
+
+                if now >= next_poll and not (pending or full_push):
+                    try:
+                        if catch_up:
+                            self.drive.pull(exclude=self.quarantined)
+                            catch_up = False
+                        else:
+                            self.drive.pull_changes(exclude=self.quarantined)
+                    except Exception as e:
+                        print(f"Error pulling changes: {e}")
+                    next_poll = now + self.poll_interval
+        finally:
+            if watcher is not None:
+                watcher.close()